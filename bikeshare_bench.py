@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the bikeshare_gold.py pipeline.
+
+Generates synthetic city files with the same layout as the Udacity csvs
+(chicago/new york city with Gender and Birth Year, washington without),
+times each stage of the pipeline in a fresh process and appends the
+results to a json lines file that can be compared between runs:
+
+    python bikeshare_bench.py --sizes 10000 100000 1000000 --output bench.jsonl
+    python bikeshare_bench.py --sizes 10000 100000 --output new.jsonl --compare bench.jsonl
+"""
+import argparse
+import builtins
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import bikeshare_gold as bg
+
+# city name used for each schema; the name decides which CITY_DATA entry is replaced
+SCHEMAS = { 'chicago': True,        # with Gender and Birth Year
+            'washington': False }   # without
+
+STAGES = ['build_cache', 'load_data', 'load_filtered', 'cached_data', 'load_cube', 'cube_stats',
+          'time_stats', 'time_window_stats', 'station_stats', 'trip_duration_stats', 'user_stats']
+
+# stages that start from nothing, so their process's peak RSS is their own; it also
+# counts the arrow buffers, which tracemalloc does not see
+LOAD_STAGES = ['build_cache', 'load_data', 'load_filtered', 'cached_data', 'load_cube']
+
+# month and day asked for by load_filtered, cached_data and cube_stats, which run
+# what main() does for a question: a pushed-down load and the cube lookup
+FILTER_MONTH, FILTER_DAY = 'march', 'monday'
+
+# pages station_stats is asked to show before answering 'no'
+STATION_PAGES = 20
+
+# rows generated and written per chunk, which bounds the generator's memory
+GENERATE_CHUNK_SIZE = 1000000
+
+#-----------------------------------------------------------------------------------------------------------------------------------
+
+def make_trips(n, demographics=True, seed=0, first_row=0):
+    """Returns n random trips laid out like the bikeshare city csvs."""
+    rng = np.random.default_rng(seed)
+
+    # start times between January 1st and the end of June 2017
+    start = np.datetime64('2017-01-01T00:00:00') + rng.integers(0, 181 * 86400, n).astype('timedelta64[s]')
+    duration = rng.gamma(2.0, 500.0, n).round().clip(60, 86400)
+    end = start + duration.astype('int64').astype('timedelta64[s]')
+
+    stations = np.array(['Station %d' % i for i in range(600)], dtype=object)
+    df = pd.DataFrame({'Start Time': np.char.replace(start.astype(str), 'T', ' '),
+                       'End Time': np.char.replace(end.astype(str), 'T', ' '),
+                       'Trip Duration': duration,
+                       'Start Station': stations[rng.zipf(1.3, n) % len(stations)],
+                       'End Station': stations[rng.zipf(1.3, n) % len(stations)],
+                       'User Type': np.where(rng.random(n) < 0.8, 'Subscriber', 'Customer')},
+                      index=np.arange(first_row, first_row + n))
+
+    if demographics:
+        gender = np.where(rng.random(n) < 0.7, 'Male', 'Female').astype(object)
+        gender[rng.random(n) < 0.1] = np.nan
+        birth_year = rng.normal(1980, 11, n).round().clip(1900, 2002)
+        birth_year[rng.random(n) < 0.1] = np.nan
+        df['Gender'] = gender
+        df['Birth Year'] = birth_year
+    return df
+
+
+def write_city_csv(filename, n, demographics=True, seed=0):
+    """Writes n synthetic trips to filename in chunks."""
+    with open(filename, 'w', newline='') as f:
+        for i, first_row in enumerate(range(0, n, GENERATE_CHUNK_SIZE)):
+            chunk = make_trips(min(GENERATE_CHUNK_SIZE, n - first_row), demographics, seed + i, first_row)
+            chunk.to_csv(f, header=(i == 0))
+
+#-----------------------------------------------------------------------------------------------------------------------------------
+
+def _call_stage(stage, city, df):
+    # runs one stage, answering station_stats' paging prompts; returns the rows it processed
+    answers = iter(['yes'] * STATION_PAGES + ['no'])
+    builtins.input = lambda prompt='': next(answers, 'no')
+    if stage == 'build_cache':
+        return len(bg.build_cache(city))
+    if stage == 'load_data':
+        return len(bg.load_data(city, 'all', 'all'))
+    if stage == 'load_filtered':
+        return len(bg.load_data(city, FILTER_MONTH, FILTER_DAY))
+    if stage == 'cached_data':
+        # from an empty cache, like the first question about a city
+        bg.CACHE.clear()
+        return len(bg.cached_data(city, FILTER_MONTH, FILTER_DAY))
+    if stage == 'load_cube':
+        return len(bg.load_cube(city))
+    if stage == 'cube_stats':
+        bg.cube_stats(df, FILTER_MONTH, FILTER_DAY)
+    elif stage == 'user_stats':
+        bg.user_stats(df, city)
+    else:
+        getattr(bg, stage)(df)
+    return len(df)
+
+
+def run_stage(stage, city, filename):
+    """Runs one stage on a city file in the current process and measures it.
+
+    The stats stages need the trips (or, for cube_stats, the cube) loaded
+    first, which dominates the process's peak RSS, so the memory of a stage
+    is measured separately:
+    stage_peak_mb is how far traced memory rose above what was allocated
+    when the stage started, in a second, traced run of the stage.  The
+    wall time comes from the first, untraced run.
+    """
+    bg.CITY_DATA[city] = filename
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        if stage == 'cube_stats':
+            df = bg.load_cube(city)
+        else:
+            df = None if stage in LOAD_STAGES else bg.load_data(city, 'all', 'all')
+
+        start_time = time.time()
+        rows = _call_stage(stage, city, df)
+        wall = time.time() - start_time
+
+        tracemalloc.start()
+        try:
+            baseline = tracemalloc.get_traced_memory()[0]
+            _call_stage(stage, city, df)
+            stage_peak = tracemalloc.get_traced_memory()[1] - baseline
+        finally:
+            tracemalloc.stop()
+
+    return {'stage': stage, 'rows': rows, 'wall': wall,
+            'rows_per_sec': rows / wall if wall else None,
+            'stage_peak_mb': stage_peak / 1024.0 / 1024.0,
+            'peak_rss_mb': bg.peak_rss_mb()}
+
+
+def prepare_caches(city, filename):
+    """Builds the parquet cache and the cube of a city file, so load_cube times loading the cube."""
+    bg.CITY_DATA[city] = filename
+    bg.load_cube(city)
+
+
+def run_benchmarks(sizes, workdir='bench_data', seed=0):
+    """Benchmarks every stage for every size and schema; yields one result dict per run."""
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    context = multiprocessing.get_context('spawn')
+    run_info = {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'pandas': pd.__version__,
+                'numpy': np.__version__}
+
+    for n in sizes:
+        for city, demographics in sorted(SCHEMAS.items()):
+            filename = os.path.join(workdir, '%s_%d.csv' % (city.replace(' ', '_'), n))
+            if not os.path.exists(filename):
+                write_city_csv(filename, n, demographics, seed)
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                pool.submit(prepare_caches, city, filename).result()
+
+            for stage in STAGES:
+                # a fresh process per stage, so no stage inherits the memory or caches of
+                # another; peak RSS still includes the load the stats stages start with
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                    result = pool.submit(run_stage, stage, city, filename).result()
+                result.update(run_info, size=n, schema=city, demographics=demographics)
+                yield result
+
+
+def compare(baseline, current, threshold=0.2, min_seconds=0.01):
+    """Prints the stages whose wall time or own peak memory grew by more than threshold.
+
+    Memory is peak_rss_mb for LOAD_STAGES and stage_peak_mb for the stats
+    stages, whose peak RSS is that of the load before them.  Both arguments
+    are lists of result dicts; wall time changes smaller than min_seconds
+    are treated as noise, and metrics missing from older result files are
+    skipped.  Returns the regressions found.
+    """
+    def key(result):
+        return result['stage'], result['size'], result['schema']
+
+    before = {key(result): result for result in baseline}
+    regressions = []
+    for result in current:
+        old = before.get(key(result))
+        if old is None:
+            continue
+        memory = 'peak_rss_mb' if result['stage'] in LOAD_STAGES else 'stage_peak_mb'
+        for metric in ('wall', memory):
+            if old.get(metric) is None or result.get(metric) is None:
+                continue
+            if metric == 'wall' and result[metric] - old[metric] < min_seconds:
+                continue
+            if old[metric] and result[metric] > old[metric] * (1 + threshold):
+                regressions.append((key(result), metric, old[metric], result[metric]))
+                print('%-20s %10d %-10s %-12s %10.3f -> %10.3f' %
+                      (key(result) + (metric, old[metric], result[metric])))
+    if not regressions:
+        print('No regressions above %d%%.' % (threshold * 100))
+    return regressions
+
+
+def read_results(filename):
+    with open(filename) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+#-----------------------------------------------------------------------------------------------------------------------------------
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the bikeshare pipeline on synthetic data.')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[10000, 100000, 1000000])
+    parser.add_argument('--workdir', default='bench_data', help='where the synthetic csvs are kept')
+    parser.add_argument('--output', default='bench_results.jsonl')
+    parser.add_argument('--compare', help='earlier results file to check for regressions')
+    parser.add_argument('--threshold', type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    results = []
+    with open(args.output, 'a') as out:
+        for result in run_benchmarks(args.sizes, args.workdir):
+            print('%-20s %-10s %10d rows %8.3f s %8.1f MB stage peak %8.1f MB process peak' %
+                  (result['stage'], result['schema'], result['rows'], result['wall'], result['stage_peak_mb'],
+                   result['peak_rss_mb'] or 0))
+            out.write(json.dumps(result) + '\n')
+            results.append(result)
+
+    if args.compare:
+        compare(read_results(args.compare), results, args.threshold)
+
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
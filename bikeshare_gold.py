@@ -4,11 +4,59 @@ Created on Sat Aug 11 18:11:09 2018
 
 @author: Nick
 """
+import argparse
+import contextlib
+import functools
+import hashlib
+import importlib
+import io
+import math
+import os
+import shutil
+import sys
+import threading
 import time
-import pandas as pd
-import numpy as np
+import tracemalloc
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import json
 
+
+class _LazyModule(object):
+    """Stands in for a module until one of its attributes is first used.
+
+    pandas, numpy and pyarrow take most of a second to import, which would
+    otherwise delay the first prompt.  The import is timed in METRICS as
+    'import <name>', after which the real module replaces the stand-in.
+    """
+
+    def __init__(self, name, alias):
+        self.__dict__.update(_name=name, _alias=alias, _module=None, _lock=threading.Lock())
+
+    def _load(self):
+        with self._lock:
+            if self._module is None:
+                with measure('import ' + self._name):
+                    self.__dict__['_module'] = importlib.import_module(self._name)
+                globals()[self._alias] = self._module
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+
+pd = _LazyModule('pandas', 'pd')
+np = _LazyModule('numpy', 'np')
+pa = _LazyModule('pyarrow', 'pa')
+pq = _LazyModule('pyarrow.parquet', 'pq')
+sketches = _LazyModule('sketches', 'sketches')
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows; peak RSS is then not reported
+    resource = None
+
 ## Filenames
 #chicago = 'chicago.csv'
 #new_york_city = 'new_york_city.csv'
@@ -18,10 +66,65 @@ CITY_DATA = { 'chicago': 'chicago.csv',
               'new york city': 'new_york_city.csv',
               'washington': 'washington.csv' }
 
+# answers get_filters accepts for the month and the day, also allowed by --months/--days
+MONTHS = ['all', 'january', 'february', 'march', 'april', 'may', 'june']
+DAYS = ['all', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+
+# rows per parquet row group; small enough that month/day filters can skip most groups
+CACHE_ROW_GROUP_SIZE = 64 * 1024
+
+# rows up to which an appended tail is merged into the last part of the cache,
+# rather than starting a new part, so a daily feed does not pile up tiny files;
+# kept to two row groups, so an append never rewrites more than that of old rows
+CACHE_PART_ROWS = 2 * CACHE_ROW_GROUP_SIZE
+
+# rows per chunk when streaming a city csv instead of loading it whole
+STREAM_CHUNK_SIZE = 100000
+
+# categories of day_of_week: weekday names in alphabetical order, so ties in the
+# most common day resolve the same way as Series.mode() on the plain strings
+DAY_NAMES = sorted(['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday'])
+
+# layout of the Start Time and End Time values: 'YYYY-MM-DD HH:MM:SS'
+TIMESTAMP_WIDTH = 19
+TIMESTAMP_SEPARATORS = { 4: '-', 7: '-', 10: ' ', 13: ':', 16: ':' }
+
+# timestamps parse_timestamps converts at a time; a block of their bytes fits in the CPU cache
+TIMESTAMP_BLOCK_ROWS = 32 * 1024
+
+# narrowest dtype for each column read from a city csv; columns a city does not
+# have are ignored.  Trip Duration is summed in float64 despite being stored as float32.
+TRIP_DTYPES = { 'Trip Duration': 'float32',
+                'Start Station': 'category',
+                'End Station': 'category',
+                'User Type': 'category',
+                'Gender': 'category',
+                'Birth Year': 'float32' }
+
+# bytes before the end of the ingested csv data that are hashed to detect rewrites
+FINGERPRINT_BYTES = 64 * 1024
+
+# start x end station pairs up to which trips are counted with a dense bincount;
+# above it only the pairs that occur are counted
+PAIR_BINCOUNT_LIMIT = 4 * 1000 * 1000
+
+# columns each stats function reads from the cached city data
+STATS_COLUMNS = { 'time_stats': ['month', 'day_of_week', 'hour'],
+                  'time_window_stats': ['Start Time'],
+                  'station_stats': ['Start Station', 'End Station'],
+                  'trip_duration_stats': ['Trip Duration'],
+                  'user_stats': ['User Type', 'Gender', 'Birth Year'] }
+
+# columns main() loads for the trips of a question: every column in STATS_COLUMNS,
+# in the order the trip pages show them
+FRAME_COLUMNS = ['Start Time', 'Trip Duration', 'Start Station', 'End Station', 'User Type',
+                 'Gender', 'Birth Year', 'month', 'day_of_week', 'hour']
+
 #-----------------------------------------------------------------------------------------------------------------------------------
 
-def get_filters():
-    
+def get_filters(on_city=None):
+    """Asks for a city, month and day; on_city(city) is called as soon as the city is known."""
+
     print('Hello! Let\'s explore some US bikeshare data!')
 
     # get user input for city (chicago, new york city, washington). HINT: Use a while loop to handle invalid inputs
@@ -36,22 +139,22 @@ def get_filters():
         else:
             print('\n\nYour answer does not match any of the above options, please try again!\n')    
 
-    # get user input for month (all, january, february, ... , june)
-    months = ['january', 'february', 'march', 'april','may', 'june', 'all']
+    # e.g. start loading the city while the month and day are being answered
+    if on_city is not None:
+        on_city(city)
 
+    # get user input for month (all, january, february, ... , june)
     while True:
         month = input(str('\nWould you like to search by one of the following months?\nEnter January, February, March, April, May, June, or all?\n '))
-        if month in months:
+        if month in MONTHS:
             break
         else:
             print ('Your answer does not match any of the above options, please try again!\n')
 
     # get user input for day of week (all, monday, tuesday, ... sunday)
-    days = ['all', 'monday', 'tuesday', 'wednesday, thursday, friday', 'saturday', 'sunday']
-
     while True:
         day = input(str('\nWould you like to search by one of the following days?\nSunday, Monday, Tuesday, Wednesday, Thursday, Friday, Saturday, or all?\n' ).lower())
-        if day in days:
+        if day in DAYS:
             break
         else:
             print ('Your answer does not match any of the above options, please try again!\n')   
@@ -62,183 +165,1908 @@ def get_filters():
 
 #-----------------------------------------------------------------------------------------------------------------------------------
 
-def load_data(city, month, day):
+def peak_rss_mb():
+    """Returns the peak resident memory of this process in MB, or None if unknown."""
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024.0 * 1024.0) if sys.platform == 'darwin' else rss / 1024.0
+
+
+class MetricsRegistry(object):
+    """In-memory list of stage measurements, optionally mirrored to a json lines file."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.records = []
+
+    def record(self, entry):
+        self.records.append(entry)
+        if self.path:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+
+    def clear(self):
+        self.records = []
+
+    def summary(self):
+        """Returns the measurements as a DataFrame, one row per measured call."""
+        return pd.DataFrame(self.records, columns=['stage', 'rows', 'wall', 'cpu', 'rss_growth_mb',
+                                                   'process_peak_rss_mb', 'traced_peak_mb'])
+
+
+# measurements of load_data and the stats functions; set BIKESHARE_METRICS to a
+# file name to also append them there as json lines
+METRICS = MetricsRegistry(os.environ.get('BIKESHARE_METRICS'))
+
+
+# stages being measured, per thread, with the traced peak each has seen so far
+_OPEN_STAGES = threading.local()
+
+
+def _fold_peak(peaks, peak):
+    # the stage on top of peaks has seen memory reach at least peak
+    if peaks and peaks[-1] is not None:
+        peaks[-1] = max(peaks[-1], peak)
+
+
+@contextlib.contextmanager
+def measure(stage, rows=None):
+    """Records the wall time, CPU time and peak memory of the enclosed block in METRICS.
+
+    The yielded dict can be updated inside the block, e.g. with the number
+    of rows processed.  rss_growth_mb is how much the block raised the
+    process's peak RSS, and process_peak_rss_mb that peak itself, which
+    covers everything the process did before.  Python-level peak memory is
+    only traced while tracemalloc is running (see profile_run); a block's
+    traced peak includes the blocks measured inside it.  Blocks measured
+    inside another one record the outermost stage as their root.
+    """
+    if not hasattr(_OPEN_STAGES, 'stack'):
+        _OPEN_STAGES.stack = []
+        _OPEN_STAGES.peaks = []
+    stack, peaks = _OPEN_STAGES.stack, _OPEN_STAGES.peaks
+    entry = {'stage': stage, 'rows': rows, 'root': stack[0] if stack else None}
+    stack.append(stage)
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        # keep the peak the enclosing stage reached so far before starting afresh
+        _fold_peak(peaks, tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+    peaks.append(0 if tracing else None)
+    rss = peak_rss_mb()
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield entry
+    finally:
+        stack.pop()
+        entry['wall'] = time.perf_counter() - wall
+        entry['cpu'] = time.process_time() - cpu
+        entry['process_peak_rss_mb'] = peak_rss_mb()
+        entry['rss_growth_mb'] = entry['process_peak_rss_mb'] - rss if rss is not None else None
+        peak = peaks.pop()
+        if tracing:
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            _fold_peak(peaks, peak)
+        entry['traced_peak_mb'] = peak / 1e6 if tracing else None
+        METRICS.record(entry)
+
+
+def instrumented(stage):
+    """Decorator that measures every call of a function as the given stage.
+
+    The rows processed are taken from a DataFrame result or, failing that,
+    a DataFrame first argument.
+    """
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with measure(stage) as entry:
+                result = func(*args, **kwargs)
+                if isinstance(result, pd.DataFrame):
+                    entry['rows'] = len(result)
+                elif args and isinstance(args[0], pd.DataFrame):
+                    entry['rows'] = len(args[0])
+            return result
+        return wrapper
+    return decorate
+
+
+@contextlib.contextmanager
+def profile_run(path=None, top=20):
+    """Profiles the enclosed block with cProfile and tracemalloc.
+
+    Prints the slowest functions and the largest allocation sites when the
+    block ends and, if path is given, saves the cProfile stats there.
+    """
+    # imported here, like ProcessPoolExecutor in run_batch, to keep startup fast
+    import cProfile
+    import pstats
+
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        if path:
+            profiler.dump_stats(path)
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(top)
+        print('Largest allocation sites:')
+        for stat in snapshot.statistics('lineno')[:top]:
+            print(stat)
+
+
+def _phase(stage):
+    # which part of answering a question a top-level stage belongs to
+    if stage.startswith('import '):
+        return 'import'
+    if stage in ('load_data', 'load_cube', 'prefetch_wait'):
+        return 'load'
+    if stage == 'prefetch':
+        return 'load in background'
+    return 'compute'
+
+
+def phase_times():
+    """Splits the recorded wall time into import, load and compute time.
+
+    Only top-level stages are added up, except imports, which are moved
+    out of whatever stage first needed the module.
+    """
+    totals = OrderedDict((phase, 0.0) for phase in ('import', 'load', 'load in background', 'compute'))
+    for entry in METRICS.records:
+        if entry['stage'].startswith('import '):
+            totals['import'] += entry['wall']
+            if entry['root'] is not None:
+                totals[_phase(entry['root'])] -= entry['wall']
+        elif entry['root'] is None:
+            totals[_phase(entry['stage'])] += entry['wall']
+    return totals
+
+
+def print_metrics():
+    """Prints the recorded measurements and the time spent importing, loading and computing."""
+    print('\nTimings:\n')
+    print(METRICS.summary().to_string(index=False))
+    print('\n' + ', '.join('%s: %.3f s' % item for item in phase_times().items()))
+    print('-'*40)
+
+#-----------------------------------------------------------------------------------------------------------------------------------
+
+def _source_key(filename):
+    """Identifies one version of a city file by its path, modification time and size."""
+    stat = os.stat(filename)
+    return {'source': os.path.abspath(filename),
+            'mtime': stat.st_mtime_ns,
+            'size': stat.st_size}
+
+
+def _cache_paths(filename, name='cache'):
+    # the parquet cache (or the aggregate cube) and its key file are kept next to the csv
+    if name == 'cache':
+        return filename + '.parquet', filename + '.cache.json'
+    return filename + '.' + name + '.parquet', filename + '.' + name + '.json'
+
+
+def _read_state(filename, name):
+    # contents of the key file of a cache, or None if it is missing or unreadable
+    try:
+        with open(_cache_paths(filename, name)[1]) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def _write_state(filename, name, state):
+    # write to a temporary file first so an interrupted update is never picked up
+    key_path = _cache_paths(filename, name)[1]
+    with open(key_path + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(key_path + '.tmp', key_path)
+
+
+def _state_key(state):
+    # the part of a cache state that identifies the csv version it was built from
+    return {field: state[field] for field in ('source', 'mtime', 'size')}
+
+
+def _write_cache(df, filename, name, key, **kwargs):
+    data_path = _cache_paths(filename, name)[0]
+    df.to_parquet(data_path + '.tmp', **kwargs)
+    os.replace(data_path + '.tmp', data_path)
+    _write_state(filename, name, key)
+
+
+def _cache_matches(filename, name):
+    # True if the cache exists and was built from the current version of the csv
+    state = _read_state(filename, name)
+    if state is None or not os.path.exists(_cache_paths(filename, name)[0]):
+        return False
+    return all(state.get(field) == value for field, value in _source_key(filename).items())
+
+
+def _fingerprint(filename, size):
+    # hash of the header and of the bytes just before size; while both are unchanged
+    # the csv is taken to have only grown since its first size bytes were ingested
+    with open(filename, 'rb') as f:
+        digest = hashlib.sha1(f.readline())
+        start = max(0, size - FINGERPRINT_BYTES)
+        f.seek(start)
+        digest.update(f.read(size - start))
+    return digest.hexdigest()
+
+
+def _fixed_width_bytes(values, width):
+    # the strings of a Series as an (n, width) uint8 matrix read straight from their
+    # arrow buffers, or None if any is missing, not a string or not width bytes long
+    try:
+        array = pa.array(values, from_pandas=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return None
+    if isinstance(array, pa.ChunkedArray):
+        array = array.combine_chunks()
+    if array.null_count or not (pa.types.is_string(array.type) or pa.types.is_large_string(array.type)):
+        return None
+    if not len(array):
+        return np.zeros((0, width), dtype=np.uint8)
+
+    offsets = np.frombuffer(array.buffers()[1], dtype=np.int64 if pa.types.is_large_string(array.type) else np.int32)
+    offsets = offsets[array.offset:array.offset + len(array) + 1]
+    if not (np.diff(offsets) == width).all():
+        return None
+    return np.frombuffer(array.buffers()[2], dtype=np.uint8)[offsets[0]:offsets[-1]].reshape(-1, width)
+
+
+def _first_of_month_days(months):
+    # days from 1970-01-01 to the first day of each month, given as months since year 0
+    # (proleptic Gregorian calendar, with years counted from March)
+    year = months // 12 - (months % 12 < 2)
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * ((months % 12 + 10) % 12) + 2) // 5
+    return era * 146097 + year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year - 719468
+
+
+def _timestamp_fields(raw):
+    # year, month, day, hour, minute and second of an (n, TIMESTAMP_WIDTH) byte matrix,
+    # or None if a byte is neither a digit nor the expected separator.  Rows are taken a
+    # block at a time so the column by column passes stay in the CPU cache
+    lowest = np.array([ord(TIMESTAMP_SEPARATORS.get(i, '0')) for i in range(TIMESTAMP_WIDTH)], dtype=np.uint8)
+    highest = np.array([ord(TIMESTAMP_SEPARATORS.get(i, '9')) for i in range(TIMESTAMP_WIDTH)], dtype=np.uint8)
+    spans = [(0, 4), (5, 7), (8, 10), (11, 13), (14, 16), (17, 19)]
+    fields = np.empty((len(spans), len(raw)), dtype=np.int32)
+
+    for first in range(0, len(raw), TIMESTAMP_BLOCK_ROWS):
+        block = raw[first:first + TIMESTAMP_BLOCK_ROWS]
+        if not ((block >= lowest) & (block <= highest)).all():
+            return None
+        digits = block - np.uint8(ord('0'))
+        for field, (start, stop) in zip(fields, spans):
+            value = digits[:, start].astype(np.int32)
+            for position in range(start + 1, stop):
+                value = value * 10 + digits[:, position]
+            field[first:first + len(block)] = value
+    return fields
+
+
+def parse_timestamps(values):
+    """Parses a Series of 'YYYY-MM-DD HH:MM:SS' strings by fixed-width arithmetic on their bytes.
+
+    Returns a dict of numpy arrays: epoch (int64 seconds since 1970), month,
+    weekday (Monday is 0) and hour, or None if any value is missing, laid
+    out differently or not a valid time; pd.to_datetime is needed then.
+    """
+    raw = _fixed_width_bytes(values, TIMESTAMP_WIDTH)
+    if raw is None or not len(raw):
+        return None
+    fields = _timestamp_fields(raw)
+    if fields is None:
+        return None
+    year, month, day, hour, minute, second = fields
+    if not ((month >= 1) & (month <= 12) & (hour < 24) & (minute < 60) & (second < 60)).all():
+        return None
+
+    # the calendar arithmetic runs once per month in the range of the data; each
+    # row looks up the first day of its month and of the month after
+    months = year * 12 + (month - 1)
+    low = months.min()
+    first = _first_of_month_days(np.arange(low, months.max() + 2, dtype=np.int64))
+    index = months - low
+    if not ((day >= 1) & (day <= first[index + 1] - first[index])).all():
+        return None
+    days = first[index] + (day - 1)
+
+    return {'epoch': days * 86400 + (hour * 3600 + minute * 60 + second),
+            'month': month.astype(np.int8),
+            'weekday': ((days + 3) % 7).astype(np.int8),      # 1970-01-01 was a Thursday
+            'hour': hour.astype(np.int8)}
+
+
+@functools.lru_cache(maxsize=None)
+def _datetime_dtype():
+    # the dtype pd.to_datetime gives parsed strings: datetime64[ns] before pandas 3, [us] since
+    return pd.to_datetime(pd.Series(['2017-01-01 00:00:00'])).dtype
+
+
+def _add_time_columns(df):
+    """Parses Start Time and derives the month, day_of_week and hour columns.
+
+    The bikeshare layout goes through parse_timestamps, about ten times
+    faster than pd.to_datetime inferring the format; anything else is
+    left to pd.to_datetime.
+    """
+    times = parse_timestamps(df['Start Time'])
+    if times is None:
+        df['Start Time'] = pd.to_datetime(df['Start Time'])
+        df['month'] = df['Start Time'].dt.month.astype('int8')
+        df['day_of_week'] = df['Start Time'].dt.day_name().astype(pd.CategoricalDtype(DAY_NAMES))
+        df['hour'] = df['Start Time'].dt.hour.astype('int8')
+        return df
+
+    weekday_codes = np.array([DAY_NAMES.index(name) for name in ('Monday', 'Tuesday', 'Wednesday', 'Thursday',
+                                                                 'Friday', 'Saturday', 'Sunday')], dtype=np.int8)
+    df['Start Time'] = times['epoch'].astype('datetime64[s]').astype(_datetime_dtype())
+    df['month'] = times['month']
+    df['day_of_week'] = pd.Categorical.from_codes(weekday_codes[times['weekday']],
+                                                  dtype=pd.CategoricalDtype(DAY_NAMES))
+    df['hour'] = times['hour']
+    return df
+
+
+def read_city_csv(filename, **kwargs):
+    """Reads a city csv straight into the compact TRIP_DTYPES plan."""
+    return pd.read_csv(filename, dtype=TRIP_DTYPES, **kwargs)
+
+
+@functools.lru_cache(maxsize=None)
+def _csv_columns(filename, version):
+    # the header of a csv; version (mtime, size) makes a rewritten file be read again
+    with open(filename, newline='') as f:
+        return tuple(pd.read_csv(f, nrows=0).columns)
+
+
+def city_columns(city):
+    """Returns the columns the city csv actually has, read from its header."""
+    return _csv_columns(CITY_DATA[city], _source_version(city))
+
+
+def memory_report(city, nrows=None):
+    """Prints the bytes per row of each column with the default and the compact dtypes."""
+    filename = CITY_DATA[city]
+
+    # the layout load_data produced before the dtype plan
+    before = pd.read_csv(filename, nrows=nrows)
+    before['Start Time'] = pd.to_datetime(before['Start Time'])
+    before['month'] = before['Start Time'].dt.month.astype('int64')
+    before['day_of_week'] = before['Start Time'].dt.day_name().astype(object)
+    before['hour'] = before['Start Time'].dt.hour.astype('int64')
+
+    after = _add_time_columns(read_city_csv(filename, nrows=nrows))
+
+    report = pd.DataFrame({'before': before.memory_usage(index=False, deep=True) / len(before),
+                           'after': after.memory_usage(index=False, deep=True) / len(after)})
+    report.loc['total'] = report.sum()
+    report['ratio'] = report['before'] / report['after']
+    print('\nBytes per row for ' + city.title() + ':\n')
+    print(report.round(1))
+    return report
+
+
+def _part_path(filename, part):
+    return os.path.join(_cache_paths(filename)[0], 'part-%05d.parquet' % part)
+
+
+def _write_part(df, filename, part):
+    # cluster the rows by month and day so each row group covers few (month, day)
+    # pairs and its min/max statistics let filtered reads skip it; the index keeps
+    # each row's position in the csv
+    df = df.sort_values(['month', 'day_of_week'], kind='stable')
+    path = _part_path(filename, part)
+    df.to_parquet(path + '.tmp', row_group_size=CACHE_ROW_GROUP_SIZE)
+    os.replace(path + '.tmp', path)
+
+
+def build_cache(city):
+    """Parses the whole city csv and stores it, with derived columns, as parquet."""
+    filename = CITY_DATA[city]
+    data_path, key_path = _cache_paths(filename)
+    key = _source_key(filename)
+
+    df = _add_time_columns(read_city_csv(filename))
+
+    # drop the old cache, which may also be a single parquet file from earlier versions
+    if os.path.exists(key_path):
+        os.remove(key_path)
+    if os.path.isdir(data_path):
+        shutil.rmtree(data_path)
+    elif os.path.exists(data_path):
+        os.remove(data_path)
+    os.makedirs(data_path)
+    _write_part(df, filename, 0)
+
+    key.update(rows=len(df), parts=1, fingerprint=_fingerprint(filename, key['size']))
+    _write_state(filename, 'cache', key)
+    return df
+
+
+def _is_append(filename, state):
+    # True if the csv only had rows added after the state was written
+    size = os.path.getsize(filename)
+    if state is None or 'fingerprint' not in state or state['size'] >= size:
+        return False
+    if state['source'] != os.path.abspath(filename) or not os.path.isdir(_cache_paths(filename)[0]):
+        return False
+    with open(filename, 'rb') as f:
+        f.seek(state['size'] - 1)
+        if f.read(1) != b'\n':
+            return False
+    return _fingerprint(filename, state['size']) == state['fingerprint']
+
+
+def _store_tail(df, filename, state):
+    # writes appended rows into the cache, merging them into the last part while it
+    # stays small; returns the number of parts
+    part = state['parts']
+    last = _part_path(filename, part - 1)
+    rows = [pq.ParquetFile(_part_path(filename, i)).metadata.num_rows for i in range(part)]
+    # more rows than the state counts were left in the last part by an append that
+    # did not finish; only rewriting the part drops them
+    leftover = sum(rows) > state['rows']
+    if not leftover and rows[-1] + len(df) > CACHE_PART_ROWS:
+        _write_part(df, filename, part)
+        return part + 1
+
+    # rows at or past state['rows'] are the leftovers
+    old = pd.read_parquet(last)
+    merged = pd.concat([old[old.index < state['rows']], df]).sort_index()
+    # concat turns categoricals with different categories into strings
+    categories = dict((col, 'category') for col, dtype in TRIP_DTYPES.items()
+                      if dtype == 'category' and col in merged.columns)
+    _write_part(merged.astype(categories), filename, part - 1)
+    return part
+
+
+def _append_tail(city, state):
+    """Parses only the rows added to the csv since the state was written."""
+    filename = CITY_DATA[city]
+    key = _source_key(filename)
+    with open(filename, 'rb') as f:
+        header = f.readline()
+        f.seek(state['size'])
+        tail = f.read(key['size'] - state['size'])
+
+    # only complete lines are ingested; a row still being written is picked up next time
+    tail = tail[:tail.rfind(b'\n') + 1]
+    if not tail:
+        return 0
+    key['size'] = state['size'] + len(tail)
+
+    df = _add_time_columns(read_city_csv(io.BytesIO(header + tail)))
+    df.index = pd.RangeIndex(state['rows'], state['rows'] + len(df))
+    key.update(rows=state['rows'] + len(df), parts=_store_tail(df, filename, state),
+               fingerprint=_fingerprint(filename, key['size']))
+    _write_state(filename, 'cache', key)
+
+    # fold the new rows into the aggregate cube if it was up to date before
+    cube_path = _cache_paths(filename, 'cube')[0]
+    if _read_state(filename, 'cube') == _state_key(state) and os.path.exists(cube_path):
+        cube = _merge_cubes([pd.read_parquet(cube_path), _aggregate_trips(df)])
+        _write_cache(cube, filename, 'cube', _state_key(key), index=False)
+    return len(df)
+
+
+def update_cache(city):
+    """Brings the parquet cache of a city up to date with its csv.
+
+    Rows appended to the csv since the last run are parsed on their own and
+    merged into the last part of the cache, or stored as a new part once
+    that holds CACHE_PART_ROWS rows (and folded into the aggregate cube),
+    so a daily refresh only costs the new data; any other change rebuilds
+    the cache.  Returns the number of rows parsed.
+    """
+    filename = CITY_DATA[city]
+    if _cache_matches(filename, 'cache'):
+        return 0
+    state = _read_state(filename, 'cache')
+    if _is_append(filename, state):
+        return _append_tail(city, state)
+    return len(build_cache(city))
+
+
+def _apply_filters(df, filters):
+    # in-memory equivalent of the parquet equality filters
+    for col, op, value in filters:
+        df = df[df[col] == value]
+    return df
+
+
+def load_city(city, columns=None, filters=None):
+    """Loads the parsed city data from the cache, updating it if the csv changed.
+
+    When columns is given only those columns are read; columns the city
+    does not have (e.g. Gender for washington) are skipped.  filters is a
+    list of (column, '==', value) predicates applied while scanning, so
+    row groups that cannot match are never read.  Rows come back in csv order.
+    """
+    with measure('update_cache') as entry:
+        entry['rows'] = update_cache(city)
+
+    filename = CITY_DATA[city]
+    paths = [_part_path(filename, part) for part in range(_read_state(filename, 'cache')['parts'])]
+    if columns is not None:
+        available = pq.read_schema(paths[0]).names
+        columns = [col for col in columns if col in available]
+    with measure('read_cache') as entry:
+        table = pq.ParquetDataset(paths, filters=filters or None).read(columns=columns, use_pandas_metadata=True)
+        df = table.to_pandas().sort_index()
+        entry['rows'] = len(df)
+    return df
+
+#-----------------------------------------------------------------------------------------------------------------------------------
+
+def month_day_filters(month, day):
+    """Turns the month and day answers from get_filters into (column, '==', value) filters."""
+    filters = []
 
-    # load data file into a dataframe
-    df = pd.read_csv(CITY_DATA[city])
- 
-    # convert the Start Time column to datetime
-    df['Start Time'] = pd.to_datetime(df['Start Time'])
- 
-    # extract month and day of week from Start Time to create new columns
-    df['month'] = df['Start Time'].dt.month
-    df['day_of_week'] = df['Start Time'].dt.weekday_name
- 
- 
     # filter by month if applicable
     if month != 'all':
-        # use the index of the months list to get the corresponding int
-        months = ['january', 'february', 'march', 'april','may', 'june']
-        month = months.index(month) + 1
- 
-        # filter by month to create the new dataframe
-        df = df[df['month'] == month]
+        # MONTHS starts with 'all', so the index of a month is its number
+        filters.append(('month', '==', MONTHS.index(month)))
  
     # filter by day of week if applicable
     if day != 'all':
-        # filter by day of week to create the new dataframe
-        df = df[df['day_of_week'] == day.title()]
-  
-    return df
+        filters.append(('day_of_week', '==', day.title()))
+
+    return filters
+
+
+@instrumented('load_data')
+def load_data(city, month, day, columns=None):
+
+    # the filters need the month and day_of_week columns as well
+    if columns is not None:
+        columns = list(columns) + [col for col in ('month', 'day_of_week') if col not in columns]
+
+    # load the parsed city data (Start Time, month, day_of_week, hour) from the cache;
+    # the filters are pushed down into the parquet scan so only the matching slice is read
+    return load_city(city, columns, month_day_filters(month, day))
+
+#-----------------------------------------------------------------------------------------------------------------------------------
+
+def _nbytes(value):
+    # rough memory footprint of a cached value; arrays and TimeIndex know their own
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(deep=True))
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(_nbytes(val) for val in value.values())
+    if hasattr(value, 'nbytes'):
+        return int(value.nbytes)
+    return sys.getsizeof(value)
+
+
+class LRUCache(object):
+    """Memory-bounded least recently used cache with hit and miss counters.
+
+    Entries are stored with a version (e.g. the source key of the csv they
+    came from); asking for a different version counts as a miss and drops
+    the stale entry.  Once the entries take more than max_bytes the least
+    recently used go first, but never the entry just stored.  Safe to use
+    from several threads.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()    # key -> (value, version, nbytes)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, version=None, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] != version:
+                self._drop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, version=None, nbytes=None):
+        with self.lock:
+            if key in self.entries:
+                self._drop(key)
+            nbytes = _nbytes(value) if nbytes is None else nbytes
+            self.entries[key] = (value, version, nbytes)
+            self.nbytes += nbytes
+            while len(self.entries) > 1 and self.nbytes > self.max_bytes:
+                self._drop(next(iter(self.entries)))
+                self.evictions += 1
+        return value
+
+    def get_or_compute(self, key, compute, version=None):
+        """Returns the cached value of key, or computes, stores and returns it."""
+        missing = object()
+        value = self.get(key, version, missing)
+        if value is missing:
+            value = self.put(key, compute(), version)
+        return value
+
+    def _drop(self, key):
+        self.nbytes -= self.entries.pop(key)[2]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(self.entries), 'bytes': self.nbytes, 'max_bytes': self.max_bytes}
+
+
+# parsed city frames, their month/day slices and the stats computed from them, kept
+# between the questions of one session; BIKESHARE_CACHE_MB sets the memory budget
+CACHE = LRUCache(int(float(os.environ.get('BIKESHARE_CACHE_MB', 512)) * 1024 * 1024))
+
+
+def _source_version(city):
+    # changes whenever the city csv is modified, invalidating what was cached from it
+    key = _source_key(CITY_DATA[city])
+    return key['mtime'], key['size']
+
+
+def cached_result(city, month, day, name, compute):
+    """Returns compute() for one city and month/day filter, memoized in CACHE until the csv changes."""
+    return CACHE.get_or_compute((name, city, month, day), compute, _source_version(city))
+
+
+def _cube(city):
+    return cached_result(city, 'all', 'all', 'cube', lambda: load_cube(city))
+
+
+# background cube loads started by prefetch_city, keyed by city
+_PREFETCHES = {}
+_PREFETCH_POOL = ThreadPoolExecutor(max_workers=1)
+
+
+def _prefetch(load, city):
+    with measure('prefetch'):
+        return load(city)
+
+
+def prefetch_city(city):
+    """Starts loading the cube of a city into CACHE in a background thread.
+
+    Loading the cube brings the parquet cache up to date first, so a changed
+    csv is parsed while the month and day are being asked.
+    """
+    _PREFETCHES[city] = _PREFETCH_POOL.submit(_prefetch, _cube, city)
+
+
+def _wait_for_prefetch(city):
+    # finish a background load first, so the cache is not updated twice at once
+    pending = _PREFETCHES.pop(city, None)
+    if pending is not None:
+        with measure('prefetch_wait'):
+            pending.result()
+
+
+def cached_cube(city):
+    """Returns the aggregate cube of a city, loaded once and kept in CACHE."""
+    _wait_for_prefetch(city)
+    return _cube(city)
+
+
+@instrumented('load_data')
+def cached_data(city, month, day):
+    """Cached equivalent of load_data: the FRAME_COLUMNS of the matching trips, kept in CACHE.
+
+    Each month/day slice is read with its filters pushed down into the
+    parquet scan, so memory follows the slice asked for, not the city.
+    """
+    _wait_for_prefetch(city)
+    return cached_result(city, month, day, 'frame', lambda: load_data(city, month, day, FRAME_COLUMNS))
+
+
+def cached_index(city, month, day):
+    """Returns the TimeIndex of the trips cached_data gives, built once and kept in CACHE."""
+    return cached_result(city, month, day, 'time_index', lambda: TimeIndex(cached_data(city, month, day)))
+
+
+def print_cache_stats():
+    print('\nCache: %(hits)d hits, %(misses)d misses, %(evictions)d evictions, '
+          '%(entries)d entries using %(bytes)d of %(max_bytes)d bytes' % CACHE.stats())
 
 #-----------------------------------------------------------------------------------------------------------------------------------
 
-def time_stats(df):
+CUBE_KEYS = ['month', 'day_of_week', 'hour', 'User Type']
+
+
+def _aggregate_trips(df):
+    # trips, duration sum and duration count per cube cell
+    df = df[CUBE_KEYS].assign(duration=df['Trip Duration'].astype('float64'))
+    return (df.groupby(CUBE_KEYS, dropna=False, observed=True)['duration']
+              .agg(['size', 'sum', 'count'])
+              .rename(columns={'size': 'trips', 'sum': 'duration_sum', 'count': 'duration_count'})
+              .reset_index())
+
+
+def _merge_cubes(cubes):
+    # the cube cells are plain sums, so cubes over different rows add up
+    return (pd.concat(cubes, ignore_index=True)
+              .groupby(CUBE_KEYS, dropna=False, observed=True)[['trips', 'duration_sum', 'duration_count']]
+              .sum()
+              .reset_index())
+
+
+def build_cube(city):
+    """Aggregates the city trips by month x day_of_week x hour x User Type and stores the cube.
+
+    Each cell holds the number of trips and the sum and count of their
+    Trip Duration, which is all time_stats and trip_duration_stats need.
+    """
+    filename = CITY_DATA[city]
+    cube = _aggregate_trips(load_city(city, CUBE_KEYS + ['Trip Duration']))
+    _write_cache(cube, filename, 'cube', _state_key(_read_state(filename, 'cache')), index=False)
+    return cube
+
+
+@instrumented('load_cube')
+def load_cube(city):
+    """Loads the aggregate cube of a city, updating it if the csv changed."""
+    filename = CITY_DATA[city]
+    update_cache(city)
+    cube_path = _cache_paths(filename, 'cube')[0]
+    if _read_state(filename, 'cube') != _state_key(_read_state(filename, 'cache')) or not os.path.exists(cube_path):
+        return build_cube(city)
+    return pd.read_parquet(cube_path)
+
+
+def _as_value_counts(counts, column):
+    # name and order grouped counts the way Series.value_counts() does
+    template = pd.Series([], name=column, dtype=object).value_counts()
+    counts = counts[counts > 0].sort_values(ascending=False, kind='stable')
+    return counts.rename(template.name).rename_axis(template.index.name)
+
+
+def cube_stats(cube, month, day):
+    """Answers time_stats, trip_duration_stats and the user type counts from a city cube."""
+    cube = _apply_filters(cube, month_day_filters(month, day))
+
+    # groupby sorts the keys, so idxmax picks the smallest value on ties like Series.mode()
+    return {'popular_month': cube.groupby('month', observed=True)['trips'].sum().idxmax(),
+            'popular_day': cube.groupby('day_of_week', observed=True)['trips'].sum().idxmax(),
+            'popular_hour': cube.groupby('hour', observed=True)['trips'].sum().idxmax(),
+            'total_duration': cube['duration_sum'].sum(),
+            'mean_duration': cube['duration_sum'].sum() / cube['duration_count'].sum(),
+            'user_types': _as_value_counts(cube.groupby('User Type', observed=True)['trips'].sum(), 'User Type')}
+
+#-----------------------------------------------------------------------------------------------------------------------------------
+
+def _code_counts(series):
+    # number of rows per value, counted with bincount over the integer codes;
+    # labels are sorted so argmax breaks ties like Series.mode()
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        codes, labels = series.cat.codes.to_numpy(), series.cat.categories
+    else:
+        codes, labels = pd.factorize(series, sort=True)
+    return np.bincount(codes[codes >= 0], minlength=len(labels)), labels
+
+
+def compute_trip_stats(df, columns=None):
+    """Computes the time, trip duration and user stats of a trip frame together.
+
+    Each column is scanned once: the modes and value counts come from
+    bincount over integer codes instead of separate mode()/value_counts()
+    calls.  Only the stats whose columns are in the frame (and in columns,
+    if given) are returned, in the dict layout of the print_*_stats functions.
+    """
+    def wanted(col):
+        return col in df.columns and (columns is None or col in columns)
+
+    stats = {}
+    if wanted('month'):
+        stats['popular_month'] = np.bincount(df['month'].to_numpy()).argmax()
+    if wanted('day_of_week'):
+        counts, labels = _code_counts(df['day_of_week'])
+        stats['popular_day'] = labels[counts.argmax()]
+    if wanted('hour'):
+        stats['popular_hour'] = np.bincount(df['hour'].to_numpy()).argmax()
+
+    if wanted('Trip Duration'):
+        durations = df['Trip Duration'].to_numpy()
+        durations = durations[~np.isnan(durations)]
+        stats['total_duration'] = durations.sum(dtype=np.float64)
+        stats['mean_duration'] = stats['total_duration'] / len(durations)
+
+    for col, key in (('User Type', 'user_types'), ('Gender', 'genders')):
+        if wanted(col):
+            counts, labels = _code_counts(df[col])
+            stats[key] = _as_value_counts(pd.Series(counts, index=labels), col)
+
+    if wanted('Birth Year'):
+        years = df['Birth Year'].to_numpy()
+        years = years[~np.isnan(years)]
+        if len(years):
+            low = years.min()
+            offsets = (years - low).astype(np.int64)
+            stats['birth_year_min'] = low
+            stats['birth_year_max'] = years.max()
+            # birth years are whole numbers, so offsets from the earliest one index a bincount
+            stats['birth_year_mode'] = low + np.bincount(offsets).argmax()
+    return stats
+
+
+@instrumented('time_stats')
+def time_stats(df, stats=None):
     """Displays statistics on the most frequent times of travel."""
  
+    if stats is None:
+        stats = compute_trip_stats(df, STATS_COLUMNS['time_stats'])
+    print_time_stats(stats)
+
+
+def print_time_stats(stats):
+
     print('\nCalculating The Most Frequent Times of Travel...\n')
-    start_time = time.time()
  
     # display the most common month
-    popular_month = df['month'].mode()[0]
-    print("The most common month of travel was " + str(popular_month) + ".\n")
+    print("The most common month of travel was " + str(stats['popular_month']) + ".\n")
  
     # display the most common day of week
-    popular_day = df['day_of_week'].mode()[0]
-    print("The most common day of travel was " + popular_day + ".\n")
+    print("The most common day of travel was " + stats['popular_day'] + ".\n")
  
     # display the most common start hour
-    # extract hour from the Start Time column to create an hour column
-    df['hour'] = df['Start Time'].dt.hour
- 
-    popular_hour = df['hour'].mode()[0]
-    print("The most common hour of travel was " + str(popular_hour) + ".\n")
+    print("The most common hour of travel was " + str(stats['popular_hour']) + ".\n")
  
-    print("\nThis took %s seconds." % (time.time() - start_time))
     print('-'*40)
     
+#-----------------------------------------------------------------------------------------------------------------------------------
+
+def _as_seconds(value):
+    # a timestamp (or anything pd.Timestamp accepts) as whole seconds since 1970
+    return pd.Timestamp(value).value // 10 ** 9
+
+
+class TimeIndex(object):
+    """Trips ordered by Start Time, for queries over arbitrary time windows.
+
+    The start times are kept as a sorted int64 array of seconds, so the
+    trips of a window are found with two binary searches, and histograms
+    are a bincount over the window's slice.  The frame itself is not
+    reordered; order maps the sorted positions back to its rows.  Build
+    one index per frame and keep it: sorting is the expensive part, and
+    subset gives the index of some of the rows without sorting again.
+    """
+
+    def __init__(self, df, order=None, seconds=None):
+        if order is None:
+            times = df['Start Time'].to_numpy()
+            rows = np.flatnonzero(~np.isnat(times))
+            seconds = times[rows].astype('datetime64[s]').astype(np.int64)
+            sort = np.argsort(seconds, kind='stable')
+            order, seconds = rows[sort], seconds[sort]
+        self.df = df
+        self.order = order
+        self.seconds = seconds
+        self.nbytes = self.order.nbytes + self.seconds.nbytes
+
+    def subset(self, rows):
+        """The index of only the rows of the frame where the boolean array rows is True."""
+        keep = rows[self.order]
+        return TimeIndex(self.df, self.order[keep], self.seconds[keep])
+
+    def _bounds(self, start, end):
+        # sorted positions of the trips starting in [start, end); None leaves that side open
+        low = 0 if start is None else int(np.searchsorted(self.seconds, _as_seconds(start), 'left'))
+        high = len(self.seconds) if end is None else int(np.searchsorted(self.seconds, _as_seconds(end), 'left'))
+        return low, max(low, high)
+
+    def count(self, start=None, end=None):
+        """Number of trips starting in [start, end)."""
+        low, high = self._bounds(start, end)
+        return high - low
+
+    def trips(self, start=None, end=None):
+        """The trips starting in [start, end), in order of Start Time."""
+        low, high = self._bounds(start, end)
+        return self.df.iloc[self.order[low:high]]
+
+    def histogram(self, bucket_seconds, start=None, end=None):
+        """Trips per calendar bucket (e.g. 3600 for every hour), indexed by the start of each bucket."""
+        low, high = self._bounds(start, end)
+        buckets = self.seconds[low:high] // bucket_seconds
+        if not len(buckets):
+            return pd.Series([], dtype='int64')
+        counts = np.bincount(buckets - buckets[0])
+        return pd.Series(counts, index=pd.to_datetime((buckets[0] + np.arange(len(counts))) * bucket_seconds, unit='s'))
+
+    def daily_profile(self, bucket_seconds, start=None, end=None):
+        """Trips per time of day (e.g. 900 for every quarter hour), indexed by 'HH:MM'."""
+        low, high = self._bounds(start, end)
+        slots = (self.seconds[low:high] % 86400) // bucket_seconds
+        counts = np.bincount(slots, minlength=-(-86400 // bucket_seconds))
+        labels = ['%02d:%02d' % divmod(slot * bucket_seconds // 60, 60) for slot in range(len(counts))]
+        return pd.Series(counts, index=labels)
+
+    def peak_window(self, width_seconds, start=None, end=None):
+        """Returns the start of the width_seconds long window holding the most trips, and their number.
+
+        Only windows starting at a trip need checking; each one's end is
+        found with one more binary search.  Only trips starting in
+        [start, end) are counted.
+        """
+        low, high = self._bounds(start, end)
+        seconds = self.seconds[low:high]
+        if not len(seconds):
+            return None, 0
+        ends = np.searchsorted(seconds, seconds + width_seconds, 'left')
+        counts = ends - np.arange(len(seconds))
+        peak = counts.argmax()
+        return pd.Timestamp(seconds[peak], unit='s'), int(counts[peak])
+
+
+def compute_time_window_stats(index, width_seconds=3600, bucket_seconds=15 * 60, start=None, end=None):
+    """Computes the time of day profiles, the busiest window and the busiest day of the indexed trips.
+
+    start and end limit the stats to the trips starting in [start, end);
+    the trips of that window are then also counted per bucket.
+    """
+    trips = index.count(start, end)
+    if not trips:
+        return {}
+    hourly = index.daily_profile(3600, start, end)
+    buckets = index.daily_profile(bucket_seconds, start, end)
+    daily = index.histogram(86400, start, end)
+    peak_start, peak_trips = index.peak_window(width_seconds, start, end)
+    stats = {'hourly_profile': hourly,
+             'bucket_profile': buckets,
+             'bucket_minutes': bucket_seconds // 60,
+             'peak_hour_of_day': hourly.idxmax(),
+             'peak_bucket_of_day': buckets.idxmax(),
+             'peak_bucket_trips': buckets.max(),
+             'peak_window_start': peak_start,
+             'peak_window_end': peak_start + pd.Timedelta(seconds=width_seconds),
+             'peak_window_trips': peak_trips,
+             'busiest_day': daily.idxmax(),
+             'busiest_day_trips': daily.max()}
+    if start is not None or end is not None:
+        stats.update(window_start=None if start is None else pd.Timestamp(start),
+                     window_end=None if end is None else pd.Timestamp(end),
+                     window_trips=trips,
+                     window_histogram=index.histogram(bucket_seconds, start, end))
+    return stats
+
+
+@instrumented('time_window_stats')
+def time_window_stats(df, stats=None, index=None):
+    """Displays the busiest times of day and the busiest time windows."""
+
+    if stats is None:
+        stats = compute_time_window_stats(TimeIndex(df) if index is None else index)
+    print_time_window_stats(stats)
+
+
+def print_time_window_stats(stats):
+
+    print('\nCalculating The Busiest Time Windows...\n')
+
+    if not stats:
+        print('There were no trips to look at.')
+    else:
+        # display the trips of the window asked for, if any, and its busiest bucket
+        if 'window_trips' in stats:
+            histogram = stats['window_histogram']
+            print("There were " + str(stats['window_trips']) + " trips from " +
+                  str(stats['window_start'] or 'the first trip') + " to " + str(stats['window_end'] or 'the last trip') +
+                  "; the busiest %d minutes started at %s (%d trips).\n" %
+                  (stats['bucket_minutes'], histogram.idxmax(), histogram.max()))
+
+        # display the busiest hour and quarter hour of the day
+        print("The busiest hour of the day started at " + stats['peak_hour_of_day'] + " (" +
+              str(stats['hourly_profile'].max()) + " trips).\n")
+        print("The busiest %d minutes of the day started at %s (%d trips).\n" %
+              (stats['bucket_minutes'], stats['peak_bucket_of_day'], stats['peak_bucket_trips']))
+
+        # display the busiest stretch of time and the busiest day overall
+        print("The busiest stretch was from " + str(stats['peak_window_start']) + " to " +
+              str(stats['peak_window_end']) + " (" + str(stats['peak_window_trips']) + " trips).\n")
+        print("The busiest day was " + str(stats['busiest_day'].date()) + " (" +
+              str(stats['busiest_day_trips']) + " trips).\n")
+
+    print('-'*40)
+
 #-----------------------------------------------------------------------------------------------------------------------------------    
     
-def station_stats(df):
+def _value_formatter(dtype):
+    # picks, once per column, how its values are written in a record
+    if dtype.kind in 'biu':
+        return str
+    if dtype.kind == 'f':
+        return lambda value: 'null' if value != value else str(value)
+    if dtype.kind == 'M':
+        return lambda value: 'null' if pd.isna(value) else '"%s"' % value
+    return lambda value: 'null' if pd.isna(value) else json.dumps(str(value))
+
+
+class TripPager(object):
+    """Cursor over the rows of a trip frame that formats one page of records at a time.
+
+    Pages are built straight from slices of the column arrays through a record
+    template compiled once, so each page costs the same wherever it is in the
+    frame.  With prefetch=True the next page is formatted in a background
+    thread while the current one is being read.
+    """
+
+    def __init__(self, df, page_size=5, prefetch=False):
+        self.columns = list(df.columns)
+        self.arrays = [df[col].array for col in self.columns]
+        self.formatters = [_value_formatter(df[col].dtype) for col in self.columns]
+        self.length = len(df)
+        self.page_size = page_size
+        self.position = 0
+
+        fields = ['  %s: %%s' % json.dumps(str(col)).replace('%', '%%') for col in self.columns]
+        self.template = '{\n' + ',\n'.join(fields) + '\n}'
+
+        self._executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        self._prefetched = None
+
+    def format_page(self, start):
+        """Returns the records from start to start + page_size as text."""
+        stop = min(start + self.page_size, self.length)
+        columns = [[fmt(value) for value in array[start:stop]]
+                   for fmt, array in zip(self.formatters, self.arrays)]
+        return '\n'.join(self.template % tuple(row) for row in zip(*columns))
+
+    def has_next(self):
+        return self.position < self.length
+
+    def seek(self, offset):
+        """Moves the cursor to the given row offset."""
+        self.position = max(0, min(offset, self.length))
+        return self
+
+    def __iter__(self):
+        while self.has_next():
+            yield self.next_page()
+
+    def next_page(self):
+        """Returns the page at the cursor and moves the cursor past it."""
+        if self._prefetched is not None and self._prefetched[0] == self.position:
+            text = self._prefetched[1].result()
+        else:
+            text = self.format_page(self.position)
+        self.position += self.page_size
+
+        if self._executor is not None and self.has_next():
+            self._prefetched = (self.position, self._executor.submit(self.format_page, self.position))
+        return text
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+
+def _station_codes(df):
+    # start and end station codes over one shared, sorted set of station names
+    start, end = df['Start Station'], df['End Station']
+    if isinstance(start.dtype, pd.CategoricalDtype) and isinstance(end.dtype, pd.CategoricalDtype):
+        labels = start.cat.categories.union(end.cat.categories)
+
+        def recode(series):
+            mapping = labels.get_indexer(series.cat.categories)
+            codes = series.cat.codes.to_numpy()
+            return np.where(codes >= 0, mapping[np.maximum(codes, 0)], -1)
+        return recode(start), recode(end), labels
+
+    codes, labels = pd.factorize(pd.concat([start, end], ignore_index=True), sort=True)
+    return codes[:len(start)], codes[len(start):], labels
+
+
+def _top_n(counts, n):
+    # positions of the n largest counts, largest first; ties go to the smaller position
+    n = min(n, np.count_nonzero(counts))
+    if n == 0:
+        return np.array([], dtype=np.int64)
+    candidates = np.argpartition(-counts, n - 1)[:n] if n < len(counts) else np.arange(len(counts))
+    # widen to every position tied with the n-th count, then order them
+    candidates = np.flatnonzero(counts >= counts[candidates].min())
+    return candidates[np.lexsort((candidates, -counts[candidates]))][:n]
+
+
+def popular_stations(df, n=1):
+    """Returns the n most common start stations, end stations and start -> end trips.
+
+    Station names are encoded to integer codes and counted with bincount;
+    trips are counted on a combined start * stations + end key, densely when
+    the number of possible pairs is small and over the occurring pairs
+    otherwise.  Each result is a Series of counts, largest first.
+    """
+    start, end, labels = _station_codes(df)
+    size = len(labels)
+
+    start_counts = np.bincount(start[start >= 0], minlength=size)
+    end_counts = np.bincount(end[end >= 0], minlength=size)
+
+    valid = (start >= 0) & (end >= 0)
+    pairs = start[valid].astype(np.int64) * size + end[valid]
+    if size * size <= PAIR_BINCOUNT_LIMIT:
+        pair_counts = np.bincount(pairs, minlength=size * size)
+        top = _top_n(pair_counts, n)
+        pair_keys, pair_counts = top, pair_counts[top]
+    else:
+        keys, counts = np.unique(pairs, return_counts=True)
+        top = _top_n(counts, n)
+        pair_keys, pair_counts = keys[top], counts[top]
+
+    top_start, top_end = _top_n(start_counts, n), _top_n(end_counts, n)
+    trips = pd.MultiIndex.from_arrays([labels[pair_keys // size], labels[pair_keys % size]],
+                                      names=['Start Station', 'End Station'])
+    return {'start_stations': pd.Series(start_counts[top_start], index=labels[top_start]),
+            'end_stations': pd.Series(end_counts[top_end], index=labels[top_end]),
+            'trips': pd.Series(pair_counts, index=trips)}
+
+
+def print_station_stats(stats):
+
+    print('\nCalculating The Most Popular Stations and Trip...\n')
+
+    # display the most commonly used start station
+    for station, count in stats['start_stations'].items():
+        print("Most common start station: " + str(station) + " (" + str(count) + " trips)")
+
+    # display the most commonly used end station
+    for station, count in stats['end_stations'].items():
+        print("Most common end station: " + str(station) + " (" + str(count) + " trips)")
+
+    # display the most frequent combination of start and end station
+    for (start, end), count in stats['trips'].items():
+        print("Most common trip: " + str(start) + " to " + str(end) + " (" + str(count) + " trips)")
+
+
+def station_stats(df, stats=None, top=1):
       
-    """Displays statistics on the most popular stations and trip."""
+    """Displays statistics on the most popular stations and trip.
+
+    Only counting the stations and formatting each page are measured, as
+    station_stats and page_trips; the time spent waiting for the user to
+    answer the paging prompt is not.
+    """
  
-    print('\nCalculating Trip Duration...\n')
-    start_time = time.time()    
+    if stats is None:
+        with measure('station_stats', len(df)):
+            stats = popular_stations(df, top)
+    print_station_stats(stats)
     
-    row_length = df.shape[0]
+    pager = TripPager(df, page_size=5, prefetch=True)
 
-    # iterate from 0 to the number of rows in steps of 5
-    for i in range(0, row_length, 5):
+    # page through the trips 5 at a time
+    while pager.has_next():
         
         yes = input('\nWould you like to examine the particular user trip data? Type \'yes\' or \'no\'\n> ')
         if yes.lower() != 'yes':
             break
         
-        # retrieve and convert data to json format
-        # split each json row data 
-        row_data = df.iloc[i: i + 5].to_json(orient='records', lines=True).split('\n')
-        for row in row_data:
-            # pretty print each user data
-            parsed_row = json.loads(row)
-            json_row = json.dumps(parsed_row, indent=2)
-            print(json_row)
+        # pretty print each user data
+        with measure('page_trips', pager.page_size):
+            page = pager.next_page()
+        print(page)
+
+    pager.close()
             
-    print("\nThis took %s seconds." % (time.time() - start_time))
     print('-'*40)
     
 #-----------------------------------------------------------------------------------------------------------------------------------
 
-def trip_duration_stats(df):
+@instrumented('trip_duration_stats')
+def trip_duration_stats(df, stats=None):
     """Displays statistics on the total and average trip duration."""
  
+    if stats is None:
+        stats = compute_trip_stats(df, STATS_COLUMNS['trip_duration_stats'])
+    print_trip_duration_stats(stats)
+
+
+def print_trip_duration_stats(stats):
+
     print('\nCalculating Trip Duration...\n')
-    start_time = time.time()
  
     # display total travel time
-    m, s = divmod(int(df['Trip Duration'].sum()), 60)
+    m, s = divmod(int(stats['total_duration']), 60)
     h, m = divmod(m, 60)
     d, h = divmod(h, 24)
     print("Total bikeshare travel time: " + str(d) + " days, " + str(h) + " hours, " + str(m) + " minutes, " + str(s) + " seconds.")
  
     # display mean travel time
-    m, s = divmod(int(df['Trip Duration'].mean()), 60)
+    m, s = divmod(int(stats['mean_duration']), 60)
     h, m = divmod(m, 60)
     print("Average bikeshare travel time: " + str(h) + " hours, " + str(m) + " minutes, " + str(s) + " seconds.")
  
-    print("\nThis took %s seconds." % (time.time() - start_time))
     print('-'*40)
 
 #-----------------------------------------------------------------------------------------------------------------------------------    
 
-def display_data(df, current_line):
+def iter_pages(df, page_size=5, start=0):
+    """Yields the frame page_size rows at a time, starting at row offset start.
+
+    Each page is a slice taken only when it is asked for, so browsing keeps
+    constant memory however far the user goes.
+    """
+    for i in range(max(start, 0), df.shape[0], page_size):
+        yield df.iloc[i:i + page_size]
+
+
+def display_data(df, current_line=0, page_size=5):
     
     print('\nPreparing individual trip data...\n')
-    start_time = time.time()
-    
-    display = input('\nWould you like to view individual trip data?'
-                    ' Type \'yes\' or \'no\'.\n')
-    display = display.lower(df)
-    if display == 'yes' or display == 'y':
-        print(df.iloc[current_line:current_line+5])
-        current_line += 5
-        return display_data(df, current_line)
-        if display == 'no' or display == 'n':
-            return
-    else:
-        print("\nI'm sorry, I'm not sure if you wanted to see more data or not. Let's try again.")
-        return display_data(df, current_line)
+
+    pages = iter_pages(df, page_size, current_line)
+    while True:
+        display = input('\nWould you like to view individual trip data?'
+                        ' Type \'yes\' or \'no\'.\n')
+        display = display.lower()
+        if display == 'yes' or display == 'y':
+            # only slicing and formatting the page is measured, not the wait for the answer
+            with measure('display_data') as entry:
+                page = next(pages, None)
+                if page is not None:
+                    entry['rows'] = len(page)
+                    text = str(page)
+            if page is None:
+                print("\nThere is no more trip data to show.")
+                break
+            print(text)
+        elif display == 'no' or display == 'n':
+            break
+        else:
+            print("\nI'm sorry, I'm not sure if you wanted to see more data or not. Let's try again.")
                     
-    print("\nThis took %s seconds." % (time.time() - start_time))
     print('-'*40)
 
 #-----------------------------------------------------------------------------------------------------------------------------------
     
-def user_stats(df, city):
+@instrumented('user_stats')
+def user_stats(df, city, stats=None):
     """Displays statistics on bikeshare users."""
  
+    if stats is None:
+        stats = compute_trip_stats(df, STATS_COLUMNS['user_stats'])
+    print_user_stats(stats, city)
+
+
+def print_user_stats(stats, city):
+
     print('\nCalculating User Stats...\n')
-    start_time = time.time()
  
+    # the demographics a city's csv does not record are skipped
+    columns = city_columns(city)
+
     #  Display counts of user types
     print("Here's a breakdown of bikeshare user types...")
-    print(df['User Type'].value_counts())
+    print(stats['user_types'])
  
     # Display counts of gender
-    if city in ('washington'):
-        print("\nSorry, gender statistics for Washington are not available.")
+    if 'Gender' not in columns or 'genders' not in stats:
+        print("\nSorry, gender statistics for " + city.title() + " are not available.")
     else:
         print("\nHere's a breakdown of gender among bikeshare users...")
-        print(df['Gender'].value_counts())
+        print(stats['genders'])
  
     # Display earliest, most recent, and most common year of birth
-    if city in ('washington'):
-        print("\nSorry, birth year statistics for Washington are not available.")
+    if 'Birth Year' not in columns or 'birth_year_min' not in stats:
+        print("\nSorry, birth year statistics for " + city.title() + " are not available.")
     else:
         print("\nAnd lastly, some information on bikeshare users' birth years...")
-        print("Earliest birth year among bikeshare users: " + str(int(df['Birth Year'].min())))
-        print("Most recent birth year among bikeshare users: " + str(int(df['Birth Year'].max())))
-        print("Most common birth year among bikeshare users: " + str(int(df['Birth Year'].mode()[0])))
+        print("Earliest birth year among bikeshare users: " + str(int(stats['birth_year_min'])))
+        print("Most recent birth year among bikeshare users: " + str(int(stats['birth_year_max'])))
+        print("Most common birth year among bikeshare users: " + str(int(stats['birth_year_mode'])))
  
-    print("\nThis took %s seconds." % (time.time() - start_time))
     print('-'*40)
 
 #-----------------------------------------------------------------------------------------------------------------------------------
 
-def main():
+def _value_counts(series):
+    # value_counts() without the zero counts categorical columns report for unused categories
+    counts = series.value_counts()
+    return counts[counts > 0]
+
+
+def _mode(counter):
+    # most common value; ties go to the smallest value, as with Series.mode()
+    return min(counter.items(), key=lambda item: (-item[1], item[0]))[0]
+
+
+def _most_common(counter, n):
+    # the n largest counts as a Series; ties go to the smallest value, as in popular_stations
+    items = sorted(counter.items(), key=lambda item: (-item[1], item[0]))[:n]
+    return pd.Series([count for value, count in items], index=[value for value, count in items])
+
+
+def _add_counts(total, counts):
+    # merge two value_counts() results, keeping the value_counts() ordering
+    if total is None:
+        return counts
+    return total.add(counts, fill_value=0).astype('int64').sort_values(ascending=False, kind='stable')
+
+
+class TripStatsAccumulator(object):
+    """Mergeable running totals behind time_stats, trip_duration_stats and user_stats.
+
+    Each chunk of trips is folded in with update(); accumulators built over
+    different parts of a file can be combined with merge().
+    """
+
+    def __init__(self):
+        self.months = Counter()
+        self.days = Counter()
+        self.hours = Counter()
+        self.duration_sum = 0.0
+        self.duration_count = 0
+        self.user_types = None
+        self.genders = None
+        self.birth_year_min = None
+        self.birth_year_max = None
+        self.birth_years = Counter()
+        self.start_stations = Counter()
+        self.end_stations = Counter()
+        self.trips = Counter()
+
+    def update(self, df):
+        self.months.update(_value_counts(df['month']).to_dict())
+        self.days.update(_value_counts(df['day_of_week']).to_dict())
+        self.hours.update(_value_counts(df['hour']).to_dict())
+
+        self.duration_sum += df['Trip Duration'].astype('float64').sum()
+        self.duration_count += df['Trip Duration'].count()
+
+        self.user_types = _add_counts(self.user_types, _value_counts(df['User Type']))
+        if 'Gender' in df.columns:
+            self.genders = _add_counts(self.genders, _value_counts(df['Gender']))
+        if 'Birth Year' in df.columns and df['Birth Year'].count():
+            self._update_birth_years(df['Birth Year'].min(), df['Birth Year'].max(),
+                                     _value_counts(df['Birth Year']).to_dict())
+        if 'Start Station' in df.columns:
+            # count each chunk first, so only its distinct stations and pairs touch the counters
+            self.start_stations.update(_value_counts(df['Start Station']).to_dict())
+            self.end_stations.update(_value_counts(df['End Station']).to_dict())
+            pairs = df.groupby(['Start Station', 'End Station'], observed=True).size()
+            self.trips.update(pairs[pairs > 0].to_dict())
+        return self
+
+    def _update_birth_years(self, low, high, counts):
+        self.birth_year_min = low if self.birth_year_min is None else min(self.birth_year_min, low)
+        self.birth_year_max = high if self.birth_year_max is None else max(self.birth_year_max, high)
+        self.birth_years.update(counts)
+
+    def merge(self, other):
+        self.months.update(other.months)
+        self.days.update(other.days)
+        self.hours.update(other.hours)
+        self.duration_sum += other.duration_sum
+        self.duration_count += other.duration_count
+        if other.user_types is not None:
+            self.user_types = _add_counts(self.user_types, other.user_types)
+        if other.genders is not None:
+            self.genders = _add_counts(self.genders, other.genders)
+        if other.birth_years:
+            self._update_birth_years(other.birth_year_min, other.birth_year_max, other.birth_years)
+        self.start_stations.update(other.start_stations)
+        self.end_stations.update(other.end_stations)
+        self.trips.update(other.trips)
+        return self
+
+    def result(self, top=1):
+        """Returns the stats dict expected by the print_*_stats functions."""
+        stats = {'popular_month': _mode(self.months),
+                 'popular_day': _mode(self.days),
+                 'popular_hour': _mode(self.hours),
+                 'total_duration': self.duration_sum,
+                 'mean_duration': self.duration_sum / self.duration_count,
+                 'user_types': self.user_types}
+        if self.genders is not None:
+            stats['genders'] = self.genders
+        if self.birth_years:
+            stats['birth_year_min'] = self.birth_year_min
+            stats['birth_year_max'] = self.birth_year_max
+            stats['birth_year_mode'] = _mode(self.birth_years)
+        if self.trips:
+            trips = _most_common(self.trips, top)
+            stats['start_stations'] = _most_common(self.start_stations, top)
+            stats['end_stations'] = _most_common(self.end_stations, top)
+            stats['trips'] = trips.set_axis(pd.MultiIndex.from_tuples(trips.index, names=['Start Station', 'End Station']))
+        return stats
+
+
+@instrumented('stream_stats')
+def stream_stats(city, month, day, chunksize=STREAM_CHUNK_SIZE):
+    """Computes the time, station, trip duration and user stats from the city csv in chunks.
+
+    Only one chunk of trips is held in memory at a time, so any file size can
+    be summarized.
+    """
+    columns = ['Start Time', 'Start Station', 'End Station', 'Trip Duration',
+               'User Type', 'Gender', 'Birth Year']
+    filters = month_day_filters(month, day)
+
+    acc = TripStatsAccumulator()
+    for chunk in read_city_csv(CITY_DATA[city], usecols=lambda col: col in columns, chunksize=chunksize):
+        acc.update(_apply_filters(_add_time_columns(chunk), filters))
+    return acc.result()
+
+#-----------------------------------------------------------------------------------------------------------------------------------
+
+# levels of the demographics cross-tabulation; a value a csv lacks or leaves empty is 'Unknown'
+DEMOGRAPHIC_LEVELS = ['city', 'Gender', 'User Type', 'Birth Decade']
+
+# Birth Decade of the trips without a birth year
+UNKNOWN_DECADE = -1
+
+
+def _labels(chunk, col):
+    # a demographic column as plain strings, with missing values and missing columns as 'Unknown'
+    if col not in chunk.columns:
+        return pd.Series('Unknown', index=chunk.index, dtype=object)
+    return chunk[col].astype(object).fillna('Unknown')
+
+
+class DemographicsAccumulator(object):
+    """Mergeable counts of riders by gender, user type and birth decade, per city.
+
+    Only the counts are kept: one per (city, gender, user type, decade)
+    combination and one per (city, birth year), so memory does not grow
+    with the number of trips.
+    """
+
+    def __init__(self):
+        self.crosstab = Counter()
+        self.birth_years = {}
+        self.columns = {}
+
+    def update(self, city, chunk, columns):
+        self.columns[city] = columns
+        years = chunk['Birth Year'].to_numpy() if 'Birth Year' in chunk.columns else np.full(len(chunk), np.nan)
+        decades = np.where(np.isnan(years), UNKNOWN_DECADE, np.floor_divide(years, 10) * 10).astype(np.int64)
+
+        keys = pd.DataFrame({'city': city,
+                             'Gender': _labels(chunk, 'Gender'),
+                             'User Type': _labels(chunk, 'User Type'),
+                             'Birth Decade': decades})
+        self.crosstab.update(keys.groupby(DEMOGRAPHIC_LEVELS, sort=False).size().to_dict())
+
+        known = years[~np.isnan(years)]
+        if len(known):
+            self.birth_years.setdefault(city, Counter()).update(_value_counts(pd.Series(known)).to_dict())
+        return self
+
+    def merge(self, other):
+        self.crosstab.update(other.crosstab)
+        for city, counts in other.birth_years.items():
+            self.birth_years.setdefault(city, Counter()).update(counts)
+        self.columns.update(other.columns)
+        return self
+
+    def table(self):
+        """Returns the cross-tabulation, one row per (city, gender, user type) and one column per decade."""
+        counts = pd.Series(self.crosstab, dtype='int64')
+        counts.index.names = DEMOGRAPHIC_LEVELS
+        table = counts.unstack('Birth Decade', fill_value=0).sort_index()
+        table = table[sorted(table.columns, key=lambda decade: (decade == UNKNOWN_DECADE, decade))]
+        return table.rename(columns=lambda decade: 'Unknown' if decade == UNKNOWN_DECADE else '%ds' % decade)
+
+    def city_stats(self, city):
+        """Returns the user stats of one city, in the layout of print_user_stats."""
+        counts = pd.Series({key[1:]: count for key, count in self.crosstab.items() if key[0] == city}, dtype='int64')
+        stats = {}
+        for level, col, key in ((1, 'User Type', 'user_types'), (0, 'Gender', 'genders')):
+            if col in self.columns[city]:
+                totals = counts.groupby(level=level).sum()
+                # value_counts() order, leaving out the trips without a value
+                totals = totals.drop('Unknown', errors='ignore').sort_index()
+                stats[key] = totals.sort_values(ascending=False, kind='stable').rename_axis(col).rename('count')
+        years = self.birth_years.get(city)
+        if years:
+            stats['birth_year_min'] = min(years)
+            stats['birth_year_max'] = max(years)
+            stats['birth_year_mode'] = _mode(years)
+        return stats
+
+
+@instrumented('demographics')
+def demographics(cities=None, chunksize=STREAM_CHUNK_SIZE):
+    """Counts riders by gender, user type and birth decade over the csvs of all cities.
+
+    Each csv is read once, in chunks of its demographic columns only, so
+    the memory used is bounded by chunksize whatever the file sizes.
+    """
+    acc = DemographicsAccumulator()
+    for city in cities or sorted(CITY_DATA):
+        columns = [col for col in STATS_COLUMNS['user_stats'] if col in city_columns(city)]
+        for chunk in read_city_csv(CITY_DATA[city], usecols=columns, chunksize=chunksize, memory_map=True):
+            acc.update(city, chunk, columns)
+    return acc
+
+
+def print_demographics(acc):
+    print('\nRiders by gender, user type and birth decade...\n')
+    with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.width', 200):
+        print(acc.table())
+    print('-'*40)
+
+    for city in sorted(acc.columns):
+        print('\n' + city.title() + ':')
+        print_user_stats(acc.city_stats(city), city)
+
+#-----------------------------------------------------------------------------------------------------------------------------------
+
+# columns approx_stats counts with Space-Saving, and how print_approx_stats names them
+APPROX_COLUMNS = [('month', 'month'),
+                  ('day_of_week', 'day of week'),
+                  ('hour', 'start hour'),
+                  ('Start Station', 'start station'),
+                  ('End Station', 'end station'),
+                  ('User Type', 'user type'),
+                  ('Gender', 'gender'),
+                  ('Birth Year', 'birth year')]
+
+# trip duration quantiles reported by approx_stats
+APPROX_QUANTILES = [0.5, 0.9, 0.99]
+
+
+def _plain_index(counts):
+    # counts keyed by plain values, so chunks with different categories line up
+    if isinstance(counts.index, pd.MultiIndex):
+        levels = [counts.index.get_level_values(i).astype(object) for i in range(counts.index.nlevels)]
+        return counts.set_axis(pd.MultiIndex.from_arrays(levels, names=counts.index.names))
+    return counts.set_axis(counts.index.astype(object))
+
+
+def _pair_hashes(index):
+    # one 64-bit hash per start x end station pair
+    return sketches.hash_values(index.to_frame(index=False).astype(object))
+
+
+class ApproxTripStats(object):
+    """Fixed-size sketches behind approx_stats.
+
+    Like TripStatsAccumulator, but the state does not grow with the number
+    of rows, stations or trips: error sets the size of every sketch, and the
+    bounds each answer holds to are reported with it.
+    """
+
+    def __init__(self, error=0.01):
+        self.error = error
+        k = int(math.ceil(1.0 / error))
+        self.counts = dict((col, sketches.SpaceSaving(k)) for col, name in APPROX_COLUMNS)
+        self.trips = sketches.SpaceSaving(k)
+        # a second, tighter bound on the counts of the most common trips
+        self.trip_counts = sketches.CountMinSketch(eps=error / 4, delta=0.01)
+        p = min(18, max(4, int(math.ceil(math.log(1.04 ** 2 / error ** 2, 2)))))
+        self.stations = sketches.HyperLogLog(p)
+        self.distinct_trips = sketches.HyperLogLog(p)
+        # the centroid around the median covers about pi / compression of the trips
+        self.durations = sketches.TDigest(max(100, int(math.ceil(math.pi / (2 * error)))))
+        self.duration_sum = 0.0
+        self.birth_year_min = None
+        self.birth_year_max = None
+
+    def update(self, df):
+        for col, name in APPROX_COLUMNS:
+            if col in df.columns:
+                self.counts[col].update(_plain_index(_value_counts(df[col])))
+
+        durations = df['Trip Duration'].to_numpy()
+        self.durations.update(durations)
+        self.duration_sum += np.nansum(durations, dtype=np.float64)
+
+        if 'Birth Year' in df.columns and df['Birth Year'].count():
+            low, high = df['Birth Year'].min(), df['Birth Year'].max()
+            self.birth_year_min = low if self.birth_year_min is None else min(self.birth_year_min, low)
+            self.birth_year_max = high if self.birth_year_max is None else max(self.birth_year_max, high)
+
+        if 'Start Station' in df.columns:
+            stations = pd.concat([_value_counts(df['Start Station']), _value_counts(df['End Station'])])
+            self.stations.update(sketches.hash_values(stations.index.astype(object)))
+
+            pairs = df.groupby(['Start Station', 'End Station'], observed=True).size()
+            pairs = _plain_index(pairs[pairs > 0])
+            hashes = _pair_hashes(pairs.index)
+            self.trips.update(pairs)
+            self.trip_counts.update(hashes, pairs.to_numpy())
+            self.distinct_trips.update(hashes)
+        return self
+
+    def merge(self, other):
+        for col, name in APPROX_COLUMNS:
+            self.counts[col].merge(other.counts[col])
+        self.trips.merge(other.trips)
+        self.trip_counts.merge(other.trip_counts)
+        self.stations.merge(other.stations)
+        self.distinct_trips.merge(other.distinct_trips)
+        self.durations.merge(other.durations)
+        self.duration_sum += other.duration_sum
+        if other.birth_year_min is not None:
+            self.birth_year_min = other.birth_year_min if self.birth_year_min is None else min(self.birth_year_min, other.birth_year_min)
+            self.birth_year_max = other.birth_year_max if self.birth_year_max is None else max(self.birth_year_max, other.birth_year_max)
+        return self
+
+    def result(self, top=3):
+        """Returns the approximate stats, each count with the most it may be over.
+
+        Counts are frames of (count, error): the true count lies between
+        count - error and count.
+        """
+        stats = {'error': self.error,
+                 'trip_count': self.durations.count,
+                 'counts': {},
+                 'total_duration': self.duration_sum,
+                 'mean_duration': self.duration_sum / self.durations.count if self.durations.count else np.nan,
+                 'duration_quantiles': pd.DataFrame({'value': self.durations.quantile(APPROX_QUANTILES),
+                                                     'rank_error': self.durations.rank_error(APPROX_QUANTILES)},
+                                                    index=APPROX_QUANTILES)}
+        for col, name in APPROX_COLUMNS:
+            if self.counts[col].total:
+                stats['counts'][col] = self.counts[col].top(top)
+
+        if self.birth_year_min is not None:
+            stats['birth_year_min'] = self.birth_year_min
+            stats['birth_year_max'] = self.birth_year_max
+
+        if self.trips.total:
+            trips = self.trips.top(top)
+            # both sketches only ever overestimate, so the smaller count is the better
+            # one; the lower bound still comes from Space-Saving
+            lower = trips['count'] - trips['error']
+            trips['count'] = np.minimum(trips['count'].to_numpy(), self.trip_counts.estimate(_pair_hashes(trips.index)))
+            trips['error'] = trips['count'] - lower
+            stats['trips'] = trips.rename_axis(['Start Station', 'End Station'])
+            stats['distinct_stations'] = self.stations.estimate()
+            stats['distinct_trips'] = self.distinct_trips.estimate()
+            stats['distinct_error'] = self.stations.relative_error()
+        return stats
+
+
+@instrumented('approx_stats')
+def approx_stats(city, month, day, error=0.01, top=3, chunksize=STREAM_CHUNK_SIZE):
+    """Approximates the trip stats of a city in one streaming pass over its csv.
+
+    Modes and top-k come from Space-Saving (and Count-Min for trips), distinct
+    counts from HyperLogLog and trip duration quantiles from a t-digest.  The
+    state is a few hundred KB at the default 1% error, whatever the file size.
+    """
+    columns = ['Start Time', 'Start Station', 'End Station', 'Trip Duration',
+               'User Type', 'Gender', 'Birth Year']
+    filters = month_day_filters(month, day)
+
+    sketch = ApproxTripStats(error)
+    for chunk in read_city_csv(CITY_DATA[city], usecols=lambda col: col in columns, chunksize=chunksize):
+        sketch.update(_apply_filters(_add_time_columns(chunk), filters))
+    return sketch.result(top)
+
+
+def _format_count(count, error):
+    # an overestimated count and the range the true count lies in
+    if not error:
+        return '%d trips' % count
+    return '%d trips (true count between %d and %d)' % (count, max(0, count - error), count)
+
+
+def print_approx_stats(stats):
+
+    print('\nApproximate statistics over %d trips, error target %g%%...\n' %
+          (stats['trip_count'], stats['error'] * 100))
+
+    for col, name in APPROX_COLUMNS:
+        if col not in stats['counts']:
+            continue
+        counts = stats['counts'][col]
+        print('Most common %s:' % name)
+        for value, row in counts.iterrows():
+            if col == 'Birth Year':
+                value = int(value)
+            print('    %s: %s' % (value, _format_count(row['count'], row['error'])))
+
+    if 'trips' in stats:
+        print('Most common trips:')
+        for (start, end), row in stats['trips'].iterrows():
+            print('    %s -> %s: %s' % (start, end, _format_count(row['count'], row['error'])))
+        print('\nDistinct stations: about %d (standard error %.1f%%)' %
+              (round(stats['distinct_stations']), stats['distinct_error'] * 100))
+        print('Distinct start x end station trips: about %d (standard error %.1f%%)' %
+              (round(stats['distinct_trips']), stats['distinct_error'] * 100))
+
+    print('\nTotal travel time: ' + str(stats['total_duration']))
+    print('Mean travel time: ' + str(stats['mean_duration']))
+    for q, row in stats['duration_quantiles'].iterrows():
+        print('%g%% of trips took at most %.1f seconds (rank error about %.2f%%)' %
+              (q * 100, row['value'], row['rank_error'] * 100))
+
+    if 'birth_year_min' in stats:
+        print('\nEarliest birth year among bikeshare users: ' + str(int(stats['birth_year_min'])))
+        print('Most recent birth year among bikeshare users: ' + str(int(stats['birth_year_max'])))
+
+    print('-'*40)
+
+#-----------------------------------------------------------------------------------------------------------------------------------
+
+def _jsonable(value):
+    # convert value_counts() results and numpy scalars to plain python for json;
+    # (start, end) station keys become 'start -> end'
+    if isinstance(value, dict):
+        return {(' -> '.join(map(str, key)) if isinstance(key, tuple) else str(key)): _jsonable(val)
+                for key, val in value.items()}
+    if isinstance(value, pd.Series):
+        return _jsonable(value.to_dict())
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, pd.Timestamp):
+        return str(value)
+    return value
+
+
+def city_reports(city, combinations):
+    """Loads one city once and computes the stats for each (month, day) combination."""
+    df = load_city(city, ['Trip Duration', 'User Type', 'Gender', 'Birth Year',
+                          'month', 'day_of_week', 'hour'])
+
+    reports = []
+    for month, day in combinations:
+        subset = _apply_filters(df, month_day_filters(month, day))
+        stats = compute_trip_stats(subset) if len(subset) else None
+        reports.append({'city': city, 'month': month, 'day': day,
+                        'trips': len(subset), 'stats': _jsonable(stats)})
+    return reports
+
+
+def run_batch(cities, months=('all',), days=('all',), processes=None):
+    """Computes the stats for every city x month x day combination.
+
+    Each city is handled by its own worker process, so the whole matrix
+    takes about as long as the slowest city.  Yields one report dict per
+    combination.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    combinations = [(month, day) for month in months for day in days]
+    with ProcessPoolExecutor(max_workers=processes or len(cities)) as pool:
+        futures = [pool.submit(city_reports, city, combinations) for city in cities]
+        for future in futures:
+            for report in future.result():
+                yield report
+
+
+def batch_main(args):
+    out = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        for report in run_batch(args.cities, args.months, args.days, args.processes):
+            out.write(json.dumps(report) + '\n')
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Explore US bikeshare data.')
+    parser.add_argument('--stream', action='store_true',
+                        help='summarize the city csv in chunks instead of loading it whole')
+    parser.add_argument('--approx', nargs='?', type=float, const=0.01, default=None, metavar='ERROR',
+                        help='approximate the stats in one pass with sketches, to within ERROR (default 0.01)')
+    parser.add_argument('--batch', action='store_true',
+                        help='compute the reports for every city x month x day without prompting')
+    parser.add_argument('--cities', nargs='+', default=sorted(CITY_DATA), choices=sorted(CITY_DATA))
+    parser.add_argument('--months', nargs='+', default=['all'], choices=MONTHS)
+    parser.add_argument('--days', nargs='+', default=['all'], choices=DAYS)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--timings', action='store_true',
+                        help='print the wall/CPU time and memory of each stage after every report')
+    parser.add_argument('--metrics', help='append the stage measurements to this json lines file')
+    parser.add_argument('--profile', nargs='?', const='', default=None, metavar='FILE',
+                        help='profile the run with cProfile and tracemalloc, saving the stats to FILE')
+    parser.add_argument('--demographics', action='store_true',
+                        help='cross-tabulate the riders of the given cities by gender, user type and birth decade')
+    parser.add_argument('--memory-report', action='store_true',
+                        help='print the bytes per row of the given cities before and after the dtype plan')
+    parser.add_argument('--output', help='write the json lines reports here instead of stdout')
+
+    def timestamp(value):
+        return str(pd.Timestamp(value))
+    parser.add_argument('--window', nargs=2, type=timestamp, metavar=('START', 'END'),
+                        help='also count the trips starting between START and END, per --bucket-minutes')
+    parser.add_argument('--bucket-minutes', type=int, default=15,
+                        help='bucket width of the time of day profile and the --window counts')
+    args = parser.parse_args(argv)
+    if args.bucket_minutes < 1:
+        parser.error('--bucket-minutes must be at least 1')
+    return args
+
+#-----------------------------------------------------------------------------------------------------------------------------------
+
+def main(streaming=False, timings=False, approx=None, window=None, bucket_minutes=15):
     while True:
-        city, month, day = get_filters()
-        df = load_data(city, month, day)
+        # the cube is only needed without --stream/--approx; it is then loaded
+        # in the background while the month and day are being asked
+        city, month, day = get_filters(None if streaming or approx else prefetch_city)
 
-        time_stats(df)
-        station_stats(df)
-        trip_duration_stats(df)
-        user_stats(df, city)
+        if approx:
+            # fixed-size sketches instead of exact counts, for very large files
+            print_approx_stats(approx_stats(city, month, day, approx))
+        elif streaming:
+            # summarize the csv chunk by chunk; paging raw trips needs the loaded frame
+            stats = stream_stats(city, month, day)
+            print_time_stats(stats)
+            print_station_stats(stats)
+            # station_stats closes the section after its paging prompts
+            print('-'*40)
+            print_trip_duration_stats(stats)
+            print_user_stats(stats, city)
+        else:
+            # time and trip duration stats come from the aggregate cube; only the trips
+            # of the month/day slice are loaded, for the other stats and paging.  All of it
+            # is cached, so asking again for a city or filter is answered from memory.
+            # The data is fetched first and each stat is measured around its cache lookup,
+            # so loading is not timed as compute and computing is not left untimed
+            cube = cached_cube(city)
+            with measure('cube_stats'):
+                stats = cached_result(city, month, day, 'cube_stats', lambda: cube_stats(cube, month, day))
+            print_time_stats(stats)
+
+            df = cached_data(city, month, day)
+            with measure('time_window_stats', len(df)):
+                window_stats = cached_result(city, month, day, 'time_window_stats',
+                                             lambda: compute_time_window_stats(
+                                                 cached_index(city, month, day), bucket_seconds=bucket_minutes * 60,
+                                                 start=window and window[0], end=window and window[1]))
+            print_time_window_stats(window_stats)
+            with measure('station_stats', len(df)):
+                popular = cached_result(city, month, day, 'station_stats', lambda: popular_stations(df))
+            station_stats(df, popular)
+            print_trip_duration_stats(stats)
+            with measure('user_stats', len(df)):
+                users = cached_result(city, month, day, 'user_stats',
+                                      lambda: compute_trip_stats(df, STATS_COLUMNS['user_stats']))
+            print_user_stats(users, city)
+
+        if timings:
+            print_metrics()
+            print_cache_stats()
+            METRICS.clear()
 
         restart = input('\nWould you like to restart? Enter yes or no.\n')
         if restart.lower() != 'yes':
             break
 
 
+def run(args):
+    if args.memory_report:
+        for city in args.cities:
+            memory_report(city)
+    elif args.demographics:
+        print_demographics(demographics(args.cities))
+    elif args.batch:
+        batch_main(args)
+    else:
+        main(streaming=args.stream, timings=args.timings, approx=args.approx,
+             window=args.window, bucket_minutes=args.bucket_minutes)
+
+
 if __name__ == "__main__":
-	main()
\ No newline at end of file
+	args = parse_args(sys.argv[1:])
+	if args.metrics:
+		METRICS.path = args.metrics
+	if args.profile is not None:
+		with profile_run(args.profile or None):
+			run(args)
+	else:
+		run(args)
\ No newline at end of file
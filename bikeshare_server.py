@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+"""
+Long-running query server for the bikeshare stats.
+
+Each city is loaded once and kept in memory, so a query costs milliseconds
+instead of a pandas import and a csv parse.  Queries are json over HTTP,
+on a TCP port or a unix socket, and are answered concurrently:
+
+    python bikeshare_server.py --port 8050 --memory-mb 2048 --preload chicago
+    curl -s localhost:8050/stats -d '{"city": "chicago", "month": "june", "day": "all", "stats": ["time_stats"]}'
+    curl -s --unix-socket /tmp/bikeshare.sock 'http://localhost/stats?city=washington&day=monday'
+    curl -s localhost:8050/stats -d '{"city": "chicago", "stats": "time_window_stats",
+                                      "start": "2017-03-06", "end": "2017-03-13", "bucket_minutes": 60}'
+    curl -s localhost:8050/status
+
+Cities and answers are evicted least recently used first once they take
+more than the memory budget.
+"""
+import argparse
+import asyncio
+import collections
+import functools
+import json
+import sys
+import time
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+
+import bikeshare_gold as bg
+
+MONTHS = bg.MONTHS
+DAYS = bg.DAYS
+
+# stats a query can ask for; all of them when it names none
+STATS = sorted(bg.STATS_COLUMNS)
+
+#-----------------------------------------------------------------------------------------------------------------------------------
+
+class QueryError(Exception):
+    """A query the server cannot answer; status is the HTTP status to reply with."""
+
+    def __init__(self, message, status=400):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class WarmCity(object):
+    """The trips of one city held in memory.
+
+    Rows are sorted by (month, day of week) and the bounds of every
+    combination are kept, so a month/day filter is a few contiguous slices
+    rather than a scan of the frame.  One bg.TimeIndex over all the trips
+    is built with the city and narrowed to each month/day filter, so time
+    window queries never sort again.
+    """
+
+    def __init__(self, city):
+        self.city = city
+        # taken before loading, so a csv changing during the load is noticed later
+        self.version = bg._source_version(city)
+        self.df = bg.load_city(city).sort_values(['month', 'day_of_week'], kind='stable', ignore_index=True)
+        self.index = bg.TimeIndex(self.df)
+        self.nbytes = int(self.df.memory_usage(deep=True).sum()) + self.index.nbytes
+
+        keys = self.df['month'].to_numpy().astype(np.int64) * 7 + self.df['day_of_week'].cat.codes.to_numpy()
+        counts = np.bincount(keys, minlength=13 * 7)
+        self.stops = np.cumsum(counts)
+        self.starts = self.stops - counts
+
+    def _ranges(self, month, day):
+        # the (start, stop) row ranges of the trips matching a month/day filter
+        filters = dict((col, value) for col, op, value in bg.month_day_filters(month, day))
+        months = [filters['month']] if 'month' in filters else range(13)
+        days = [bg.DAY_NAMES.index(filters['day_of_week'])] if 'day_of_week' in filters else range(7)
+
+        # one (start, stop) range per matching combination, joining neighbouring ones
+        ranges = []
+        for key in sorted(m * 7 + d for m in months for d in days):
+            start, stop = self.starts[key], self.stops[key]
+            if ranges and ranges[-1][1] == start:
+                ranges[-1] = (ranges[-1][0], stop)
+            elif stop > start:
+                ranges.append((start, stop))
+        return ranges
+
+    def select(self, month, day):
+        """Returns the trips matching the month and day answers, as get_filters gives them."""
+        if month == 'all' and day == 'all':
+            return self.df
+        ranges = self._ranges(month, day)
+        if len(ranges) == 1:
+            return self.df.iloc[ranges[0][0]:ranges[0][1]]
+        return self.df.take(np.concatenate([np.arange(start, stop) for start, stop in ranges] or [[]]).astype(np.intp))
+
+    def time_index(self, month, day):
+        """Returns the bg.TimeIndex of the trips matching the month and day answers."""
+        if month == 'all' and day == 'all':
+            return self.index
+        rows = np.zeros(len(self.df), dtype=bool)
+        for start, stop in self._ranges(month, day):
+            rows[start:stop] = True
+        return self.index.subset(rows)
+
+
+class CityFrames(object):
+    """Warm cities and the answers computed from them, kept in a bg.LRUCache.
+
+    Everything is versioned by the city csv, so a changed csv is reloaded
+    and its old answers are never served.  The least recently used cities
+    and answers are evicted once they take more than max_bytes.
+    """
+
+    def __init__(self, max_bytes):
+        self.cache = bg.LRUCache(max_bytes)
+        self.locks = collections.defaultdict(asyncio.Lock)
+        self.loads = 0
+
+    async def get(self, city):
+        # one load per city at a time; queries for other cities carry on meanwhile
+        async with self.locks[city]:
+            warm = self.cache.get(('city', city), bg._source_version(city))
+            if warm is None:
+                warm = await asyncio.get_running_loop().run_in_executor(None, WarmCity, city)
+                self.cache.put(('city', city), warm, warm.version, warm.nbytes)
+                self.loads += 1
+            return warm
+
+    def time_index(self, warm, month, day):
+        """Returns the bg.TimeIndex of a month/day filter of a warm city, kept in the cache."""
+        if month == 'all' and day == 'all':
+            return warm.index
+        return self.cache.get_or_compute(('index', warm.city, month, day),
+                                         lambda: warm.time_index(month, day), warm.version)
+
+    async def answer(self, warm, month, day, stats, top, window):
+        key = ('answer', warm.city, month, day, tuple(stats), top, window)
+        result = self.cache.get(key, warm.version)
+        if result is None:
+            index = functools.partial(self.time_index, warm, month, day)
+            result = await asyncio.get_running_loop().run_in_executor(
+                None, answer, warm, month, day, stats, top, window, index)
+            self.cache.put(key, result, warm.version)
+        return result
+
+    def status(self):
+        status = self.cache.stats()
+        status['cities'] = dict((key[1], {'rows': len(warm.df), 'bytes': nbytes})
+                                for key, (warm, version, nbytes) in list(self.cache.entries.items())
+                                if key[0] == 'city')
+        status['loads'] = self.loads
+        return status
+
+#-----------------------------------------------------------------------------------------------------------------------------------
+
+def _positive_int(params, name, default):
+    try:
+        value = int(params.get(name, default))
+    except (TypeError, ValueError):
+        value = 0
+    if value < 1:
+        raise QueryError('%s must be a whole number of at least 1' % name)
+    return value
+
+
+def _timestamp(params, name):
+    # a window bound as an ISO timestamp string, or None if the query leaves it open
+    if params.get(name) in (None, ''):
+        return None
+    try:
+        value = bg.pd.Timestamp(str(params[name]))
+    except ValueError:
+        value = bg.pd.NaT
+    if value is bg.pd.NaT:
+        raise QueryError('%s must be a timestamp such as 2017-03-06 08:00' % name)
+    return str(value)
+
+
+def parse_query(params):
+    """Checks a query's parameters and fills in the defaults; returns (city, month, day, stats, top, window).
+
+    window is (start, end, window_minutes, bucket_minutes) for the time
+    window stats; start and end are None when the query leaves them open.
+    """
+    city = str(params.get('city', '')).lower()
+    if city == 'new york':
+        city += ' city'
+    if city not in bg.CITY_DATA:
+        raise QueryError('city must be one of %s' % ', '.join(sorted(bg.CITY_DATA)))
+
+    month = str(params.get('month', 'all')).lower()
+    if month not in MONTHS:
+        raise QueryError('month must be one of %s' % ', '.join(MONTHS))
+    day = str(params.get('day', 'all')).lower()
+    if day not in DAYS:
+        raise QueryError('day must be one of %s' % ', '.join(DAYS))
+
+    stats = params.get('stats') or STATS
+    if isinstance(stats, str):
+        stats = stats.split(',')
+    if not isinstance(stats, list) or not all(isinstance(name, str) for name in stats):
+        raise QueryError('stats must be a name or a list of names from %s' % ', '.join(STATS))
+    unknown = [name for name in stats if name not in STATS]
+    if unknown:
+        raise QueryError('unknown stats %s; choose from %s' % (', '.join(map(str, unknown)), ', '.join(STATS)))
+
+    try:
+        top = int(params.get('top', 1))
+    except (TypeError, ValueError):
+        raise QueryError('top must be a whole number')
+
+    window = (_timestamp(params, 'start'), _timestamp(params, 'end'),
+              _positive_int(params, 'window_minutes', 60), _positive_int(params, 'bucket_minutes', 15))
+    return city, month, day, stats, top, window
+
+
+def answer(warm, month, day, stats, top=1, window=(None, None, 60, 15), index=None):
+    """Computes the requested stats over the matching trips of a warm city.
+
+    index returns the bg.TimeIndex of those trips; by default it is
+    narrowed from the city's index.
+    """
+    subset = warm.select(month, day)
+    result = {}
+    for name in stats:
+        if not len(subset):
+            result[name] = None
+        elif name == 'station_stats':
+            result[name] = bg._jsonable(bg.popular_stations(subset, top))
+        elif name == 'time_window_stats':
+            start, end, window_minutes, bucket_minutes = window
+            time_index = index() if index is not None else warm.time_index(month, day)
+            result[name] = bg._jsonable(bg.compute_time_window_stats(
+                time_index, window_minutes * 60, bucket_minutes * 60, start, end))
+        else:
+            result[name] = bg._jsonable(bg.compute_trip_stats(subset, bg.STATS_COLUMNS[name]))
+    return {'city': warm.city, 'month': month, 'day': day, 'trips': len(subset), 'stats': result}
+
+
+async def query(frames, params):
+    start_time = time.perf_counter()
+    city, month, day, stats, top, window = parse_query(params)
+    warm = await frames.get(city)
+    # a copy, so the cached answer is left as it was
+    result = dict(await frames.answer(warm, month, day, stats, top, window))
+    result['elapsed_ms'] = (time.perf_counter() - start_time) * 1000
+    return result
+
+#-----------------------------------------------------------------------------------------------------------------------------------
+
+async def read_request(reader):
+    """Reads one HTTP request; returns (method, target, headers, body), or None at the end of the connection."""
+    line = await reader.readline()
+    if not line.strip():
+        return None
+    parts = line.decode('latin-1').split()
+    if len(parts) != 3:
+        raise QueryError('malformed request line')
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    body = await reader.readexactly(int(headers.get('content-length', 0)))
+    return parts[0], parts[1], headers, body
+
+
+async def dispatch(frames, method, target, body):
+    """Routes a request; returns (status, reply dict)."""
+    url = urlsplit(target)
+    if url.path == '/status' and method == 'GET':
+        return 200, frames.status()
+    if url.path != '/stats':
+        raise QueryError('not found; use /stats or /status', 404)
+    if method not in ('GET', 'POST'):
+        raise QueryError('use GET or POST', 405)
+
+    params = dict((name, values[-1]) for name, values in parse_qs(url.query).items())
+    if body:
+        try:
+            params.update(json.loads(body))
+        except (ValueError, TypeError):
+            raise QueryError('the request body must be a json object')
+    return 200, await query(frames, params)
+
+
+def write_response(writer, status, reply, keep_alive):
+    body = json.dumps(reply).encode('utf-8')
+    reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed'}.get(status, 'Error')
+    writer.write(('HTTP/1.1 %d %s\r\n'
+                  'Content-Type: application/json\r\n'
+                  'Content-Length: %d\r\n'
+                  'Connection: %s\r\n\r\n' % (status, reason, len(body), 'keep-alive' if keep_alive else 'close')
+                  ).encode('latin-1') + body)
+
+
+async def handle_connection(reader, writer, frames):
+    """Answers the requests of one connection, keeping it open between them unless asked not to."""
+    try:
+        while True:
+            keep_alive = False
+            try:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                method, target, headers, body = request
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                status, reply = await dispatch(frames, method, target, body)
+            except QueryError as error:
+                status, reply = error.status, {'error': str(error)}
+            except Exception as error:
+                status, reply = 500, {'error': '%s: %s' % (type(error).__name__, error)}
+
+            write_response(writer, status, reply, keep_alive)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(args):
+    frames = CityFrames(int(args.memory_mb * 1024 * 1024))
+    for city in args.preload:
+        await frames.get(city)
+
+    handler = functools.partial(handle_connection, frames=frames)
+    if args.unix_socket:
+        server = await asyncio.start_unix_server(handler, path=args.unix_socket)
+        print('Serving bikeshare stats on unix socket %s' % args.unix_socket)
+    else:
+        server = await asyncio.start_server(handler, args.host, args.port)
+        print('Serving bikeshare stats on http://%s:%d' % (args.host, args.port))
+    sys.stdout.flush()
+    async with server:
+        await server.serve_forever()
+
+#-----------------------------------------------------------------------------------------------------------------------------------
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Answer bikeshare stats queries from warm in-memory data.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8050)
+    parser.add_argument('--unix-socket', help='listen on this unix socket instead of a TCP port')
+    parser.add_argument('--memory-mb', type=float, default=1024,
+                        help='memory budget for the warm cities and answers; least recently used go first')
+    parser.add_argument('--preload', nargs='*', default=[], choices=sorted(bg.CITY_DATA),
+                        help='cities to load before accepting queries')
+    args = parser.parse_args(argv)
+
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
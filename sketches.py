@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+Small streaming sketches for approximate statistics over files too large to
+summarize exactly.
+
+    CountMinSketch  - frequency of any item, overestimated by at most eps * N
+    SpaceSaving     - the k heaviest items (modes, top-k) with per-item error
+    HyperLogLog     - number of distinct items within about 1.04 / sqrt(2 ** p)
+    TDigest         - quantiles, most accurate towards the tails
+
+Every sketch is fed in batches (numpy arrays or pandas objects), keeps a
+fixed amount of state and can be merged with another sketch of the same
+shape, so a file can be summarized chunk by chunk or in parallel.
+"""
+import math
+
+import numpy as np
+import pandas as pd
+
+
+def hash_values(values):
+    """Returns 64-bit hashes of a Series, of each row of a DataFrame, or of an array."""
+    if isinstance(values, (pd.Series, pd.DataFrame)):
+        return pd.util.hash_pandas_object(values, index=False).to_numpy()
+    return pd.util.hash_array(np.asarray(values))
+
+#-----------------------------------------------------------------------------------------------------------------------------------
+
+class CountMinSketch(object):
+    """Frequency estimates for a stream of hashed items.
+
+    An estimate is never below the true count and, with probability
+    1 - delta, at most eps * total above it.
+    """
+
+    def __init__(self, eps=0.001, delta=0.01, seed=0):
+        self.eps = eps
+        self.delta = delta
+        self.width = int(math.ceil(math.e / eps))
+        self.depth = int(math.ceil(math.log(1.0 / delta)))
+        self.seed = seed
+        rng = np.random.default_rng(seed)
+        # odd multipliers, one per row, for multiplicative hashing
+        self.salts = rng.integers(1, 2 ** 63, self.depth, dtype=np.uint64) | np.uint64(1)
+        self.table = np.zeros((self.depth, self.width), dtype=np.int64)
+        self.total = 0
+
+    def _columns(self, hashes):
+        with np.errstate(over='ignore'):
+            return [(((hashes * salt) >> np.uint64(32)) % np.uint64(self.width)).astype(np.intp)
+                    for salt in self.salts]
+
+    def update(self, hashes, counts=None):
+        """Adds the hashed items, each with a count of one or with the given counts."""
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        counts = np.ones(len(hashes), dtype=np.int64) if counts is None else np.asarray(counts, dtype=np.int64)
+        for row, columns in enumerate(self._columns(hashes)):
+            self.table[row] += np.bincount(columns, weights=counts, minlength=self.width).astype(np.int64)
+        self.total += int(counts.sum())
+        return self
+
+    def estimate(self, hashes):
+        """Returns the estimated count of each hashed item."""
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        rows = [self.table[row, columns] for row, columns in enumerate(self._columns(hashes))]
+        return np.min(rows, axis=0)
+
+    def error_bound(self):
+        """Most an estimate exceeds the true count, with probability 1 - delta."""
+        return self.eps * self.total
+
+    def merge(self, other):
+        if other.table.shape != self.table.shape or other.seed != self.seed:
+            raise ValueError('Count-Min sketches must have the same shape and seed to be merged.')
+        self.table += other.table
+        self.total += other.total
+        return self
+
+#-----------------------------------------------------------------------------------------------------------------------------------
+
+class SpaceSaving(object):
+    """The k heaviest items of a stream, with overestimated counts.
+
+    Batches are folded in as exact counts (e.g. value_counts() of a chunk).
+    A reported count is at most errors[item] above the true count, errors
+    never exceed total / k, and every item more frequent than total / k is
+    kept.  Merging follows the mergeable Space-Saving rule: an item missing
+    from a full summary is assumed to have that summary's smallest count.
+    """
+
+    def __init__(self, k=100):
+        self.k = k
+        self.counts = pd.Series(dtype='int64')
+        self.errors = pd.Series(dtype='int64')
+        self.total = 0
+
+    def _floor(self):
+        # the count an item not in the summary may have had
+        return int(self.counts.min()) if len(self.counts) >= self.k else 0
+
+    def _combine(self, counts, errors, floor, total):
+        index = self.counts.index.union(counts.index)
+        own_floor = self._floor()
+        merged = (self.counts.reindex(index, fill_value=own_floor) +
+                  counts.reindex(index, fill_value=floor))
+        merged_errors = (self.errors.reindex(index, fill_value=own_floor) +
+                         errors.reindex(index, fill_value=floor))
+
+        # keep the k largest; ties go to the first item in index order
+        keep = merged.sort_index(kind='stable').sort_values(ascending=False, kind='stable').index[:self.k]
+        self.counts = merged[keep].astype('int64')
+        self.errors = merged_errors[keep].astype('int64')
+        self.total += total
+        return self
+
+    def update(self, counts):
+        """Folds in the exact counts of one batch, given as a Series indexed by item."""
+        counts = counts[counts > 0].astype('int64')
+        return self._combine(counts, pd.Series(0, index=counts.index, dtype='int64'), 0, int(counts.sum()))
+
+    def merge(self, other):
+        return self._combine(other.counts, other.errors, other._floor(), other.total)
+
+    def top(self, n=1):
+        """Returns the n heaviest items with their estimated count and error bound."""
+        return pd.DataFrame({'count': self.counts, 'error': self.errors}).iloc[:n]
+
+    def error_bound(self):
+        """Most any reported count exceeds the true count."""
+        return self.total / float(self.k)
+
+#-----------------------------------------------------------------------------------------------------------------------------------
+
+class HyperLogLog(object):
+    """Estimates the number of distinct hashed items with 2 ** p one-byte registers.
+
+    The relative standard error of estimate() is about 1.04 / sqrt(2 ** p).
+    """
+
+    def __init__(self, p=14):
+        if not 4 <= p <= 18:
+            raise ValueError('p must be between 4 and 18.')
+        self.p = p
+        self.m = 1 << p
+        self.registers = np.zeros(self.m, dtype=np.uint8)
+
+    def update(self, hashes):
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        width = 64 - self.p
+        index = (hashes >> np.uint64(width)).astype(np.intp)
+        rest = hashes & np.uint64((1 << width) - 1)
+
+        # rank = position of the first set bit in the remaining bits; only the top
+        # 53 of them are looked at so the float conversion in frexp stays exact
+        shift = max(0, width - 53)
+        exponent = np.frexp((rest >> np.uint64(shift)).astype(np.float64))[1] + shift
+        rank = np.where(rest == 0, width + 1, width - exponent + 1).astype(np.uint8)
+        np.maximum.at(self.registers, index, rank)
+        return self
+
+    def estimate(self):
+        m = float(self.m)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(np.ldexp(1.0, -self.registers.astype(np.int64)))
+        zeros = np.count_nonzero(self.registers == 0)
+        if estimate <= 2.5 * m and zeros:
+            # linear counting is more accurate for small cardinalities
+            estimate = m * math.log(m / zeros)
+        return estimate
+
+    def relative_error(self):
+        return 1.04 / math.sqrt(self.m)
+
+    def merge(self, other):
+        if other.p != self.p:
+            raise ValueError('HyperLogLog sketches must have the same p to be merged.')
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+#-----------------------------------------------------------------------------------------------------------------------------------
+
+class TDigest(object):
+    """Streaming quantile sketch (a merging t-digest with the k1 scale function).
+
+    Values are summarized as weighted centroids.  The scale function lets
+    centroids near the median hold many values and keeps them small near
+    the tails, so extreme quantiles are the most accurate.  About
+    compression / 2 centroids are kept.
+    """
+
+    def __init__(self, compression=100):
+        self.compression = compression
+        self.means = np.array([], dtype=np.float64)
+        self.weights = np.array([], dtype=np.float64)
+        self.count = 0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def _compress(self, means, weights):
+        means = np.concatenate([self.means, means])
+        weights = np.concatenate([self.weights, weights])
+        order = np.argsort(means, kind='mergesort')
+        means, weights = means[order], weights[order]
+
+        cumulative = np.cumsum(weights)
+        q = (cumulative - weights / 2) / cumulative[-1]
+        # centroids fall into unit steps of k(q) = compression / (2 pi) * asin(2q - 1)
+        k = np.floor(self.compression / (2 * np.pi) * np.arcsin(np.clip(2 * q - 1, -1, 1)))
+        starts = np.concatenate([[0], np.flatnonzero(np.diff(k)) + 1])
+
+        self.weights = np.add.reduceat(weights, starts)
+        self.means = np.add.reduceat(means * weights, starts) / self.weights
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if len(values):
+            self.count += len(values)
+            self.min = min(self.min, values.min())
+            self.max = max(self.max, values.max())
+            self._compress(values, np.ones(len(values)))
+        return self
+
+    def merge(self, other):
+        if other.count:
+            self.count += other.count
+            self.min = min(self.min, other.min)
+            self.max = max(self.max, other.max)
+            self._compress(other.means, other.weights)
+        return self
+
+    def quantile(self, q):
+        """Returns the estimated q-quantile (q may be an array)."""
+        if not self.count:
+            return np.nan
+        centers = np.cumsum(self.weights) - self.weights / 2
+        xs = np.concatenate([[0], centers, [self.weights.sum()]])
+        ys = np.concatenate([[self.min], self.means, [self.max]])
+        return np.interp(np.asarray(q) * self.weights.sum(), xs, ys)
+
+    def rank_error(self, q):
+        """Rough bound on the rank error of quantile(q), as a fraction of all values.
+
+        It is half the weight of the centroid the quantile falls in.
+        """
+        if not self.count:
+            return np.nan
+        cumulative = np.cumsum(self.weights)
+        index = np.minimum(np.searchsorted(cumulative, np.asarray(q) * cumulative[-1]), len(cumulative) - 1)
+        return self.weights[index] / (2 * cumulative[-1])
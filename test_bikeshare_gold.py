@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for bikeshare_gold.py: the fixed-width Start Time parser and the
+ingestion of rows appended to a city csv.
+
+    python -m pytest -q test_bikeshare_gold.py
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+import bikeshare_bench
+import bikeshare_gold as bg
+
+
+def _as_strings(seconds):
+    # 'YYYY-MM-DD HH:MM:SS' strings of int64 seconds since 1970
+    return pd.Series(np.char.replace(seconds.astype('datetime64[s]').astype(str), 'T', ' '), dtype=object)
+
+
+def _check_against_to_datetime(values):
+    times = bg.parse_timestamps(values)
+    assert times is not None
+    expected = pd.to_datetime(values)
+    assert (times['epoch'] == expected.to_numpy().astype('datetime64[s]').astype(np.int64)).all()
+    assert (times['month'] == expected.dt.month.to_numpy()).all()
+    assert (times['weekday'] == expected.dt.weekday.to_numpy()).all()
+    assert (times['hour'] == expected.dt.hour.to_numpy()).all()
+
+
+def test_parse_timestamps_matches_to_datetime():
+    # random times from 1890 to 2200: before and after 1970, and across 1900, 2000 and 2100
+    rng = np.random.default_rng(0)
+    low = np.datetime64('1890-01-01T00:00:00').astype(np.int64)
+    high = np.datetime64('2200-01-01T00:00:00').astype(np.int64)
+    _check_against_to_datetime(_as_strings(rng.integers(low, high, 200000)))
+
+
+@pytest.mark.parametrize('value', ['1970-01-01 00:00:00', '1969-12-31 23:59:59', '1900-02-28 12:00:00',
+                                   '1900-03-01 00:00:00', '2000-02-29 23:59:59', '2016-12-31 23:59:59',
+                                   '2017-06-30 23:59:59', '2100-02-28 00:00:00', '2100-03-01 00:00:00'])
+def test_parse_timestamps_calendar_edges(value):
+    _check_against_to_datetime(pd.Series([value, '2017-01-01 00:00:00'], dtype=object))
+
+
+@pytest.mark.parametrize('value', ['2017-02-29 00:00:00',      # not a leap year
+                                   '1900-02-29 00:00:00',      # nor is 1900
+                                   '2017-04-31 00:00:00',
+                                   '2017-00-10 00:00:00',
+                                   '2017-13-01 00:00:00',
+                                   '2017-01-00 00:00:00',
+                                   '2017-01-01 24:00:00',
+                                   '2017-01-01 00:60:00',
+                                   '2017-01-01 00:00:60',
+                                   '2017/01/01 00:00:00',
+                                   '2017-01-01T00:00:00',
+                                   '2017-01-01 0:00:00',
+                                   '2017-01-01 00:00:00.5',
+                                   '2017-0a-01 00:00:00',
+                                   None])
+def test_parse_timestamps_rejects_other_values(value):
+    assert bg.parse_timestamps(pd.Series(['2017-01-01 00:00:00', value], dtype=object)) is None
+
+
+def test_parse_timestamps_rejects_a_bad_value_in_a_later_block(monkeypatch):
+    monkeypatch.setattr(bg, 'TIMESTAMP_BLOCK_ROWS', 7)
+    values = ['2017-01-01 00:00:00'] * 20 + ['2017-01-01 00:00:6x']
+    assert bg.parse_timestamps(pd.Series(values, dtype=object)) is None
+
+
+def test_parse_timestamps_empty():
+    assert bg.parse_timestamps(pd.Series([], dtype=object)) is None
+
+
+def test_add_time_columns_falls_back_to_to_datetime():
+    # the same times in another layout go through pd.to_datetime and give the same columns
+    values = _as_strings(np.random.default_rng(1).integers(1483228800, 1498867200, 1000))
+    fast = bg._add_time_columns(pd.DataFrame({'Start Time': values}))
+    slow = bg._add_time_columns(pd.DataFrame({'Start Time': values.str.replace(' ', 'T')}))
+    assert bg.parse_timestamps(values.str.replace(' ', 'T')) is None
+    pd.testing.assert_frame_equal(fast, slow)
+
+#-----------------------------------------------------------------------------------------------------------------------------------
+
+@pytest.fixture
+def city(tmp_path, monkeypatch):
+    """A chicago csv in a temporary directory, with the first 1000 of 6000 trips written and cached."""
+    trips = bikeshare_bench.make_trips(6000, seed=2)
+    filename = str(tmp_path / 'chicago.csv')
+    trips.iloc[:1000].to_csv(filename)
+    monkeypatch.setitem(bg.CITY_DATA, 'chicago', filename)
+    monkeypatch.setattr(bg, 'CACHE_PART_ROWS', 1500)
+    bg.load_cube('chicago')
+    return filename, trips
+
+
+def _append(filename, trips, text=None):
+    with open(filename, 'a', newline='') as f:
+        f.write(trips.to_csv(header=False) if text is None else text)
+
+
+def _check_matches_rebuild(filename):
+    # the cache and the cube hold what parsing the whole csv again gives
+    expected = bg._add_time_columns(bg.read_city_csv(filename))
+    pd.testing.assert_frame_equal(bg.load_city('chicago'), expected, check_categorical=False)
+    cube = bg.load_cube('chicago').sort_values(bg.CUBE_KEYS, ignore_index=True)
+    rebuilt = bg._aggregate_trips(expected).sort_values(bg.CUBE_KEYS, ignore_index=True)
+    pd.testing.assert_frame_equal(cube, rebuilt, check_dtype=False, check_categorical=False)
+
+
+def test_append_matches_rebuild(city):
+    filename, trips = city
+    for start, stop in [(1000, 1200), (1200, 1300), (1300, 2500), (2500, 2600)]:
+        _append(filename, trips.iloc[start:stop])
+        # only the new rows are parsed
+        assert bg.update_cache('chicago') == stop - start
+        _check_matches_rebuild(filename)
+    # the tails were merged into the last part, but for the one that did not fit
+    assert bg._read_state(filename, 'cache')['parts'] == 2
+
+
+def test_append_skips_a_partial_last_line(city):
+    filename, trips = city
+    text = trips.iloc[1000:1010].to_csv(header=False)
+    cut = text.index('\n', len(text) // 2) + 10
+    _append(filename, None, text[:cut])
+    complete = text[:cut].count('\n')
+    assert bg.update_cache('chicago') == complete
+    assert len(bg.load_city('chicago')) == 1000 + complete
+
+    # the rest of the line is picked up with the next append
+    _append(filename, None, text[cut:])
+    assert bg.update_cache('chicago') == 10 - complete
+    _check_matches_rebuild(filename)
+
+
+@pytest.mark.parametrize('part_rows', [10 ** 9, 1500])
+def test_interrupted_append_leaves_no_duplicates(city, monkeypatch, part_rows):
+    # an append that wrote its rows into the last part but died before saving the
+    # state leaves rows at or past state['rows'] behind; redoing it drops them, also
+    # when the redo would otherwise start a new part
+    filename, trips = city
+    state = bg._read_state(filename, 'cache')
+    _append(filename, trips.iloc[1000:1400])
+    monkeypatch.setattr(bg, 'CACHE_PART_ROWS', 10 ** 9)
+    bg.update_cache('chicago')
+    bg._write_state(filename, 'cache', state)
+
+    monkeypatch.setattr(bg, 'CACHE_PART_ROWS', part_rows)
+    assert bg.update_cache('chicago') == 400
+    _check_matches_rebuild(filename)
+
+
+def test_interrupted_new_part_is_overwritten(city):
+    # a part written past the state's parts by an append that did not finish is never read
+    filename, trips = city
+    state = bg._read_state(filename, 'cache')
+    _append(filename, trips.iloc[1000:2000])
+    bg.update_cache('chicago')
+    assert bg._read_state(filename, 'cache')['parts'] == 2
+    bg._write_state(filename, 'cache', state)
+
+    assert bg.update_cache('chicago') == 1000
+    _check_matches_rebuild(filename)
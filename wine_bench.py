@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks the wine csv ingestion of wine_data.py against plain pd.read_csv.
+
+Generates wine files of the requested sizes by resampling the rows of
+wineQualityReds.csv and wineQualityWhites.csv, one file per color in each
+layout (the quoted, row-numbered files of this repo and the ';'-separated
+UCI files), then times reading every file of a size both ways:
+
+    python wine_bench.py --sizes 100000 1000000 --output wine_bench.jsonl
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+import wine_data
+
+SOURCES = { 'red': 'wineQualityReds.csv',
+            'white': 'wineQualityWhites.csv' }
+
+# csv layouts generated for each color: (file suffix, to_csv arguments)
+LAYOUTS = { 'repo': ('.csv', {'index': True, 'index_label': '', 'quoting': 2}),
+            'uci': ('.uci.csv', {'index': False, 'sep': ';'}) }
+
+#-----------------------------------------------------------------------------------------------------------------------------------
+
+def make_wine_files(n, workdir='bench_data', seed=0):
+    """Writes n resampled wines per color in each layout; returns the filenames with the read_csv arguments they need."""
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    rng = np.random.default_rng(seed)
+    files = []
+    for color, source in sorted(SOURCES.items()):
+        df = pd.read_csv(source, index_col=0)
+        for layout, (suffix, to_csv_kwargs) in sorted(LAYOUTS.items()):
+            filename = os.path.join(workdir, 'wine_%s_%s_%d%s' % (color, layout, n, suffix))
+            if not os.path.exists(filename):
+                sample = df.iloc[rng.integers(0, len(df), n)].set_axis(np.arange(1, n + 1))
+                if layout == 'uci':
+                    sample.columns = [col.replace('.', ' ') for col in sample.columns]
+                sample.to_csv(filename, **to_csv_kwargs)
+            files.append((filename, {'index_col': 0} if layout == 'repo' else {'sep': ';'}))
+    return files
+
+
+def read_plain(files):
+    # what winequality.py did: one default pd.read_csv after another, then fixing up the names
+    frames = [pd.read_csv(filename, **read_kwargs) for filename, read_kwargs in files]
+    return [df.rename(columns=wine_data.canonical_name) for df in frames]
+
+
+def read_ingested(files):
+    return wine_data.read_wine_files([filename for filename, read_kwargs in files])
+
+
+def time_reader(reader, files, repeat=3):
+    """Returns the best wall time of reader(files) over repeat runs, with the memory of its frames."""
+    best = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        frames = reader(files)
+        wall = time.perf_counter() - start_time
+        best = wall if best is None else min(best, wall)
+    rows = sum(len(df) for df in frames)
+    nbytes = sum(int(df.memory_usage(deep=True).sum()) for df in frames)
+    return {'rows': rows, 'wall': best, 'rows_per_sec': rows / best, 'mb': nbytes / 1024.0 / 1024.0}
+
+
+def run_benchmarks(sizes, workdir='bench_data', repeat=3):
+    """Yields one result dict per size and reader."""
+    run_info = {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'pandas': pd.__version__,
+                'engine': wine_data.CSV_ENGINE,
+                'cpus': os.cpu_count()}
+    for n in sizes:
+        files = make_wine_files(n, workdir)
+        for name, reader in (('read_csv', read_plain), ('read_wine_files', read_ingested)):
+            result = time_reader(reader, files, repeat)
+            result.update(run_info, size=n, reader=name, files=len(files))
+            yield result
+
+#-----------------------------------------------------------------------------------------------------------------------------------
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the wine csv ingestion against pd.read_csv.')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[10000, 100000, 1000000],
+                        help='wines per generated file')
+    parser.add_argument('--workdir', default='bench_data', help='where the generated csvs are kept')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='append the results to this json lines file')
+    args = parser.parse_args(argv)
+
+    out = open(args.output, 'a') if args.output else None
+    try:
+        for result in run_benchmarks(args.sizes, args.workdir, args.repeat):
+            print('%-16s %10d rows %8.3f s %12.0f rows/s %8.1f MB' %
+                  (result['reader'], result['rows'], result['wall'], result['rows_per_sec'], result['mb']))
+            if out:
+                out.write(json.dumps(result) + '\n')
+    finally:
+        if out:
+            out.close()
+
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
@@ -0,0 +1,463 @@
+# -*- coding: utf-8 -*-
+"""
+Data handling for the wine quality analysis (winequality.py).
+
+DatasetStore hands frames from one section of the analysis to the next
+without a csv round-trip.  The live frame is passed on as it is, and a
+typed parquet checkpoint is written only when its content has changed:
+
+    store = DatasetStore()
+    store.put('winequality_edited', wine_df)     # checkpoint, if changed
+    wine_df = store.get('winequality_edited')    # the same frame, no parsing
+
+read_wine_files reads wine csvs of either layout (the UCI ';'-separated
+files or the quoted, row-numbered files in this repo) concurrently into
+one schema, and load_sources stacks several wine files (or frames) into
+one frame with a categorical column naming the source of each row:
+
+    wine_df = load_sources({'red': 'winequality-red.csv', 'white': 'winequality-white.csv'})
+
+GroupEngine answers many group-by questions from shared group codes, and
+quantile_edges / bin_values bin a column at its quantiles without sorting.
+"""
+import csv
+import hashlib
+import io
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+
+import sketches
+
+# parquet metadata key under which a checkpoint records the hash of its content
+HASH_KEY = b'wine_data.content_hash'
+
+# canonical column names of the wine datasets; every column but quality is read as float32
+WINE_COLUMNS = ['fixed acidity', 'volatile acidity', 'citric acid', 'residual sugar', 'chlorides',
+                'free sulfur dioxide', 'total sulfur dioxide', 'density', 'pH', 'sulphates', 'alcohol',
+                'quality']
+WINE_DTYPES = dict((col, 'int8' if col == 'quality' else 'float32') for col in WINE_COLUMNS)
+
+# bytes read from the start of a csv to detect its delimiter, quoting and index column
+SNIFF_BYTES = 16 * 1024
+
+# key combinations up to which group codes are found with a dense bincount;
+# above it only the combinations that occur are found, by sorting
+DENSE_GROUP_LIMIT = 4 * 1000 * 1000
+
+# aggregations GroupEngine computes
+AGGREGATIONS = ['mean', 'sum', 'count', 'size', 'min', 'max']
+
+# csv parser: 'pyarrow' (its own reader, which releases the GIL so files read in
+# threads are parsed in parallel) or a pd.read_csv engine such as 'c'
+CSV_ENGINE = 'pyarrow'
+
+
+def content_hash(df):
+    """Returns a hex digest of a frame's values, index, column names and dtypes."""
+    digest = hashlib.sha1()
+    digest.update(repr([(str(col), str(dtype)) for col, dtype in df.dtypes.items()]).encode('utf-8'))
+    digest.update(pd.util.hash_pandas_object(df.index).to_numpy().tobytes())
+    for col in df.columns:
+        # column by column, so every column is hashed with its own dtype
+        digest.update(pd.util.hash_pandas_object(df[col], index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+#-----------------------------------------------------------------------------------------------------------------------------------
+
+def canonical_name(name):
+    """Maps a column name such as 'fixed.acidity' or 'total_sulfur-dioxide' to its WINE_COLUMNS form."""
+    spaced = ' '.join(re.split(r'[\s._-]+', name.strip()))
+    for col in WINE_COLUMNS:
+        if spaced.lower() == col.lower():
+            return col
+    return spaced
+
+
+def sniff_csv(filename, sample_bytes=SNIFF_BYTES):
+    """Returns the delimiter, quote character, index column and header of a csv.
+
+    A leading column with an empty name (as R's write.csv writes the row
+    numbers) is taken as the index column.
+    """
+    with open(filename, newline='') as f:
+        sample = f.read(sample_bytes)
+    if '\n' in sample:
+        # whole lines only, so a cut off last line does not confuse the sniffer
+        sample = sample[:sample.rindex('\n') + 1]
+    dialect = csv.Sniffer().sniff(sample, delimiters=',;\t|')
+    header = next(csv.reader(io.StringIO(sample), dialect))
+    return {'sep': dialect.delimiter,
+            'quotechar': dialect.quotechar or '"',
+            'index_col': 0 if header and not header[0].strip() else None,
+            'header': header}
+
+
+def _read_arrow(filename, layout, dtype):
+    # pyarrow's csv reader converts to the dtypes while parsing, where pd.read_csv's
+    # pyarrow engine converts every column again afterwards
+    table = pacsv.read_csv(filename,
+                           parse_options=pacsv.ParseOptions(delimiter=layout['sep'], quote_char=layout['quotechar']),
+                           convert_options=pacsv.ConvertOptions(column_types=dict(
+                               (raw, pa.from_numpy_dtype(np.dtype(col_dtype))) for raw, col_dtype in dtype.items())))
+    df = table.to_pandas()
+    if layout['index_col'] is not None:
+        df = df.set_index(df.columns[layout['index_col']])
+    return df
+
+
+def read_wine_csv(filename):
+    """Reads a wine csv of any layout into the WINE_COLUMNS names and WINE_DTYPES.
+
+    Columns outside WINE_COLUMNS keep their (spaced) names and inferred
+    dtypes.  An index column becomes the index.
+    """
+    layout = sniff_csv(filename)
+    header = layout.pop('header')
+    names = dict((raw, canonical_name(raw)) for raw in header[1 if layout['index_col'] == 0 else 0:])
+    dtype = dict((raw, WINE_DTYPES[col]) for raw, col in names.items() if col in WINE_DTYPES)
+
+    if CSV_ENGINE == 'pyarrow':
+        df = _read_arrow(filename, layout, dtype)
+    else:
+        df = pd.read_csv(filename, engine=CSV_ENGINE, dtype=dtype, **layout)
+    df.index.name = None
+    return df.rename(columns=names)
+
+
+def read_wine_files(filenames, workers=None):
+    """Reads several wine csvs with read_wine_csv in a thread pool; returns the frames in order."""
+    with ThreadPoolExecutor(max_workers=workers or min(len(filenames), os.cpu_count() or 1) or 1) as pool:
+        return list(pool.map(read_wine_csv, filenames))
+
+
+def stack_frames(frames, labels, column='color'):
+    """Stacks frames into one frame with a RangeIndex, adding column = the label of each row's frame.
+
+    Every output column is allocated once at its full length and each
+    frame is copied into its slice, so stacking N frames costs one copy of
+    the data (DataFrame.append in a loop copies it N times).  Columns some
+    frames lack are filled with NaN.  column is a categorical over labels,
+    stored as one byte per row.
+    """
+    if len(set(labels)) != len(labels) or len(labels) != len(frames):
+        raise ValueError('Each frame needs its own label.')
+    sizes = [len(frame) for frame in frames]
+    stops = np.cumsum(sizes, dtype=np.int64)
+    starts = stops - sizes
+    total = int(stops[-1]) if len(frames) else 0
+
+    columns = []
+    for frame in frames:
+        columns.extend(col for col in frame.columns if col not in columns)
+
+    data = {}
+    for col in columns:
+        dtypes = [frame[col].to_numpy().dtype for frame in frames if col in frame.columns]
+        if len(dtypes) < len(frames):
+            dtypes.append(np.float64)
+        values = np.empty(total, dtype=np.result_type(*dtypes))
+        for frame, start, stop in zip(frames, starts, stops):
+            values[start:stop] = frame[col].to_numpy() if col in frame.columns else np.nan
+        data[col] = values
+
+    data[column] = pd.Categorical.from_codes(np.repeat(np.arange(len(frames)), sizes), categories=labels)
+    return pd.DataFrame(data, copy=False)
+
+
+def load_sources(sources, column='color', workers=None):
+    """Loads several wine datasets into one frame, labelling each row with its source.
+
+    sources maps each label (e.g. 'red', or a vintage) to a csv filename or
+    an already loaded frame, in the order the rows should appear.  Files are
+    read together with read_wine_files(filenames, workers).
+    """
+    filenames = [source for source in sources.values() if not isinstance(source, pd.DataFrame)]
+    frames = iter(read_wine_files(filenames, workers) if filenames else [])
+    return stack_frames([source if isinstance(source, pd.DataFrame) else next(frames)
+                         for source in sources.values()], list(sources), column)
+
+#-----------------------------------------------------------------------------------------------------------------------------------
+
+class DatasetStore(object):
+    """Named frames shared between the sections of an analysis, checkpointed as parquet.
+
+    put() keeps the live frame for later get() calls and writes it to
+    <directory>/<name>.parquet, unless the checkpoint already holds the
+    same content.  Parquet keeps the dtypes, so categoricals such as
+    acidity_levels come back as categoricals when a checkpoint is read in
+    a new session.
+    """
+
+    def __init__(self, directory='.'):
+        self.directory = directory
+        self.frames = {}
+        self.hashes = {}
+        self.writes = 0
+
+    def path(self, name):
+        return os.path.join(self.directory, name + '.parquet')
+
+    def _saved_hash(self, name):
+        # the hash recorded in the checkpoint on disk, if there is one
+        if name not in self.hashes and os.path.exists(self.path(name)):
+            metadata = pq.read_schema(self.path(name)).metadata or {}
+            if HASH_KEY in metadata:
+                self.hashes[name] = metadata[HASH_KEY].decode('ascii')
+        return self.hashes.get(name)
+
+    def put(self, name, df, checkpoint=True):
+        """Makes df the current version of name; returns True if a checkpoint was written."""
+        self.frames[name] = df
+        return self.checkpoint(name) if checkpoint else False
+
+    def checkpoint(self, name):
+        """Writes the live frame of name to disk if it differs from the last checkpoint."""
+        df = self.frames[name]
+        digest = content_hash(df)
+        if digest == self._saved_hash(name):
+            return False
+
+        table = pa.Table.from_pandas(df)
+        metadata = dict(table.schema.metadata or {})
+        metadata[HASH_KEY] = digest.encode('ascii')
+        table = table.replace_schema_metadata(metadata)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = self.path(name)
+        pq.write_table(table, path + '.tmp')
+        os.replace(path + '.tmp', path)
+        self.hashes[name] = digest
+        self.writes += 1
+        return True
+
+    def get(self, name):
+        """Returns the live frame of name, reading its checkpoint only in a new session."""
+        if name not in self.frames:
+            if not os.path.exists(self.path(name)):
+                raise KeyError('%s has not been stored in %s' % (name, os.path.abspath(self.directory)))
+            self.frames[name] = pd.read_parquet(self.path(name))
+        return self.frames[name]
+
+    def __contains__(self, name):
+        return name in self.frames or os.path.exists(self.path(name))
+
+#-----------------------------------------------------------------------------------------------------------------------------------
+
+def _float_dtype(values):
+    # edges are kept at the precision of the values they cut, so a value equal to an edge stays on its side
+    return values.dtype if values.dtype.kind == 'f' else np.dtype(np.float64)
+
+
+def quantile_edges(values, quantiles):
+    """Returns the quantiles of values, interpolated linearly as Series.quantile() does.
+
+    The order statistics the quantiles need are found with one np.partition
+    (a selection, O(n)), instead of sorting or describe()-ing every column.
+    Missing values are ignored.
+    """
+    values = np.asarray(values)
+    if values.dtype.kind == 'f':
+        values = values[~np.isnan(values)]
+    if not len(values):
+        return np.full(len(quantiles), np.nan, dtype=_float_dtype(values))
+
+    positions = (len(values) - 1) * np.asarray(quantiles, dtype=np.float64)
+    low = np.floor(positions).astype(np.intp)
+    high = np.ceil(positions).astype(np.intp)
+    selected = np.partition(values, np.unique(np.concatenate([low, high])))
+    below = selected[low].astype(np.float64)
+    above = selected[high].astype(np.float64)
+    return (below + (above - below) * (positions - low)).astype(_float_dtype(values))
+
+
+def sketch_edges(batches, quantiles, compression=200):
+    """Estimates the quantiles of values arriving in batches, with a sketches.TDigest.
+
+    For data too large to hold; the digest keeps about compression / 2
+    centroids.  The 0 and 1 quantiles are the exact minimum and maximum.
+    Returns the edges and the digest, whose rank_error() bounds their error.
+    """
+    digest = sketches.TDigest(compression)
+    dtype = np.dtype(np.float64)
+    for batch in batches:
+        batch = np.asarray(batch)
+        dtype = _float_dtype(batch)
+        digest.update(batch)
+    return np.asarray(digest.quantile(quantiles)).astype(dtype), digest
+
+
+def bin_codes(values, edges):
+    """Returns the bin of each value as int8 codes, as pd.cut(values, edges) numbers them.
+
+    Bins are closed on the right and the lowest edge is excluded, so values
+    at or below the first edge, above the last one or missing get -1.
+    """
+    values = np.asarray(values)
+    edges = np.asarray(edges).astype(_float_dtype(values))
+    if len(edges) < 2 or len(edges) > 128 or not (np.diff(edges) > 0).all():
+        raise ValueError('Bin edges must be 2 to 128 increasing values.')
+    codes = np.searchsorted(edges, values, side='left') - 1
+    codes[codes >= len(edges) - 1] = -1
+    return codes.astype(np.int8)
+
+
+def bin_values(values, edges, labels):
+    """Bins values like pd.cut(values, edges, labels=labels), returning an ordered categorical."""
+    categorical = pd.Categorical.from_codes(bin_codes(values, edges), categories=labels, ordered=True)
+    if isinstance(values, pd.Series):
+        return pd.Series(categorical, index=values.index, name=values.name)
+    return categorical
+
+#-----------------------------------------------------------------------------------------------------------------------------------
+
+class GroupEngine(object):
+    """Group-by aggregations of a frame that share their group codes.
+
+    Every key column is factorized once, the first time a key uses it, and
+    every combination of keys is turned into group codes once; all the
+    aggregations over the same keys then reuse them.  Sums, counts and
+    means are a bincount of the group codes, min and max a reduceat over
+    the rows sorted by group.  Results match df.groupby(keys)[columns].agg(agg),
+    groups with a missing key left out: missing values of any dtype are
+    skipped by every aggregation but size, and sum and mean need numeric
+    columns.  Make a new engine after changing a key column of the frame.
+    """
+
+    def __init__(self, df):
+        self.df = df
+        self.keys = {}
+        self.groups = {}
+        self.orders = {}
+
+    def _factorize(self, col):
+        # (codes, index of the values) of a key column; missing values get code -1
+        if col not in self.keys:
+            values = self.df[col]
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                self.keys[col] = (values.cat.codes.to_numpy(), pd.CategoricalIndex(values.cat.categories,
+                                                                                  dtype=values.dtype, name=col))
+            else:
+                codes, uniques = pd.factorize(values, sort=True)
+                self.keys[col] = (codes, pd.Index(uniques, name=col))
+        return self.keys[col]
+
+    def _groups(self, keys):
+        # (rows, group code of each row, group index); rows is None when no key is missing
+        if keys not in self.groups:
+            factorized = [self._factorize(col) for col in keys]
+            combined = np.zeros(len(self.df), dtype=np.int64)
+            valid = np.ones(len(self.df), dtype=bool)
+            for codes, uniques in factorized:
+                combined = combined * len(uniques) + codes
+                valid &= codes >= 0
+            rows = None if valid.all() else np.flatnonzero(valid)
+            if rows is not None:
+                combined = combined[rows]
+
+            size = int(np.prod([len(uniques) for codes, uniques in factorized], dtype=np.float64))
+            if size <= DENSE_GROUP_LIMIT:
+                present = np.bincount(combined, minlength=size) > 0
+                observed = np.flatnonzero(present)
+                codes = (np.cumsum(present) - 1)[combined]
+            else:
+                observed, codes = np.unique(combined, return_inverse=True)
+
+            # split each observed combination back into the codes of its keys
+            levels = []
+            for key_codes, uniques in reversed(factorized):
+                observed, level = np.divmod(observed, len(uniques))
+                levels.insert(0, uniques.take(level))
+            index = levels[0] if len(levels) == 1 else pd.MultiIndex.from_arrays(levels)
+            self.groups[keys] = (rows, codes, index)
+        return self.groups[keys]
+
+    def _order(self, keys):
+        # (rows sorted by group, first sorted row of each group); only min and max need them
+        if keys not in self.orders:
+            rows, codes, index = self._groups(keys)
+            order = np.argsort(codes, kind='stable')
+            starts = np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=len(index)))[:-1]]).astype(np.intp)
+            self.orders[keys] = (order, starts)
+        return self.orders[keys]
+
+    def _aggregate(self, keys, col, agg):
+        rows, codes, index = self._groups(keys)
+        series = self.df[col]
+        numeric = pd.api.types.is_numeric_dtype(series.dtype)
+        if agg in ('sum', 'mean') and not numeric:
+            raise TypeError('%s of %r needs a numeric column, not %s' % (agg, col, series.dtype))
+        missing = series.isna().to_numpy()
+        if numeric and isinstance(series.dtype, pd.api.extensions.ExtensionDtype):
+            # nullable numbers as plain numpy ones; the missing ones are masked out below
+            values = series.to_numpy(dtype=series.dtype.numpy_dtype, na_value=0)
+        else:
+            values = series.to_numpy()
+        if rows is not None:
+            values, missing = values[rows], missing[rows]
+        floating = values.dtype.kind == 'f'
+        ngroups = len(index)
+
+        if agg == 'size':
+            return np.bincount(codes, minlength=ngroups)
+        if agg in ('min', 'max'):
+            if not len(values):
+                return values
+            reduce = {'min': np.fmin, 'max': np.fmax}[agg] if floating else {'min': np.minimum, 'max': np.maximum}[agg]
+            if floating or not missing.any():
+                order, starts = self._order(keys)
+                return reduce.reduceat(values[order], starts)
+            # without NaN to skip, the missing values are left out and groups with none left get NaN
+            codes, values = codes[~missing], values[~missing]
+            counts = np.bincount(codes, minlength=ngroups)
+            order = np.argsort(codes, kind='stable')
+            present = np.flatnonzero(counts)
+            if not len(present):
+                return np.full(ngroups, np.nan)
+            starts = (np.cumsum(counts) - counts)[present]
+            return pd.Series(reduce.reduceat(values[order], starts), index=present).reindex(range(ngroups)).to_numpy()
+
+        if missing.any():
+            codes, values = codes[~missing], values[~missing]
+        counts = np.bincount(codes, minlength=ngroups)
+        if agg == 'count':
+            return counts
+        sums = np.bincount(codes, weights=values, minlength=ngroups)
+        if agg == 'sum':
+            return sums.astype(values.dtype if floating else np.int64)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = sums / counts
+        return means.astype(values.dtype) if floating else means
+
+    def agg(self, keys, columns, agg):
+        """Returns df.groupby(keys)[columns].agg(agg) as a frame, one column per aggregated column."""
+        if agg not in AGGREGATIONS:
+            raise ValueError('agg must be one of %s' % ', '.join(AGGREGATIONS))
+        keys = tuple([keys] if isinstance(keys, str) else keys)
+        columns = [columns] if isinstance(columns, str) else list(columns)
+        index = self._groups(keys)[2]
+        return pd.DataFrame(dict((col, self._aggregate(keys, col, agg)) for col in columns), index=index)
+
+    def aggregate(self, specs):
+        """Computes several (keys, columns, agg) specs; returns a dict of result frames.
+
+        specs is either a dict of named specs, and the results are keyed by
+        the same names, or a list of specs, and each result is keyed by its
+        spec with the lists made tuples.
+        """
+        if isinstance(specs, dict):
+            named = list(specs.items())
+        else:
+            named = [(tuple(tuple(part) if isinstance(part, list) else part for part in spec), spec) for spec in specs]
+        return dict((name, self.agg(*spec)) for name, spec in named)
+
+
+def group_aggregate(df, specs):
+    """Computes several (keys, columns, agg) group-by specs over df at once; see GroupEngine.aggregate."""
+    return GroupEngine(df).aggregate(specs)
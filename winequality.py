@@ -55,16 +55,21 @@ import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
+from wine_data import (DatasetStore, GroupEngine, bin_values, group_aggregate, load_sources, quantile_edges,
+                       read_wine_files)
 get_ipython().run_line_magic('matplotlib', 'inline')
 from IPython.core.interactiveshell import InteractiveShell
 InteractiveShell.ast_node_interactivity = "all"
 sns.set_context('notebook')
 get_ipython().run_line_magic('config', "InlineBackend.figure_format = 'retina'")
 
+# hands wine_df from section to section; checkpoints go to winequality_edited.parquet
+store = DatasetStore()
+
 
 # ### Assessing Data:
 # 
-# Using Pandas, explore winequality-red.csv and winequality-white.csv in the Jupyter notebook below to answer quiz questions below the notebook about these characteristics of the datasets:
+# Using Pandas, explore wineQualityReds.csv and wineQualityWhites.csv (or the UCI winequality-red.csv and winequality-white.csv) in the Jupyter notebook below to answer quiz questions below the notebook about these characteristics of the datasets:
 # 
 # number of samples in each dataset
 # number of columns in each dataset
@@ -76,14 +81,8 @@ get_ipython().run_line_magic('config', "InlineBackend.figure_format = 'retina'")
 # In[ ]:
 
 
-red_df = pd.read_csv('winequality-red.csv', sep=';')
-white_df = pd.read_csv('winequality-white.csv', sep=';')
-
-
-# In[ ]:
-
-
-red_df.rename(columns={'total_sulfur-dioxide':'total_sulfur_dioxide'}, inplace=True)
+# read both datasets at once; either layout gives the same column names and compact dtypes
+red_df, white_df = read_wine_files(['wineQualityReds.csv', 'wineQualityWhites.csv'])
 
 
 # - How many samples of red wine are there?
@@ -154,44 +153,16 @@ red_df.density.mean()
 
 # ### Appending Data:
 # 
-# Combine the red and white datasets to make your analysis more efficient. Use NumPy to create a new column that preserves color information, and then use pandas to combine the dataframes.
+# Combine the red and white datasets to make your analysis more efficient. The loader stacks the dataframes into one and adds a new column that preserves color information.
 # 
-# ### Create Color Columns:
-# Create two arrays as long as the number of rows in the red and white dataframes that repeat the value “red” or “white.” 
-
-# In[ ]:
-
-
-# create color array for red dataframe
-color_red = np.repeat('red', red_df.shape[0])
-
-# create color array for white dataframe
-color_white = np.repeat('white', white_df.shape[0])
-
-
-# Add arrays to the red and white dataframes. Do this by setting a new column called 'color' to the appropriate array. 
+# ### Combine DataFrames:
+# The 'color' column is a categorical with the values “red” and “white,” stored in one byte per row, and the combined dataframe gets a clean index.
 
 # In[ ]:
 
 
-red_df['color'] = color_red
-red_df.head()
-
-
-# In[ ]:
-
-
-white_df['color'] = color_white
-white_df.head()
-
-
-# ### Combine DataFrames with Append:
-
-# In[ ]:
-
-
-# append dataframes
-wine_df = red_df.append(white_df)
+# combine dataframes, labelling each row with its color
+wine_df = load_sources({'red': red_df, 'white': white_df}, column='color')
 
 # view dataframe to check for success
 wine_df.head(10)
@@ -205,19 +176,19 @@ wine_df.describe()
 
 # ### Save Combined Dataset:
 # 
-# - Save the newly combined dataframe as winequality_edited.csv. 
-# - Set index=False to avoid saving with an unnamed column.
+# - Save the newly combined dataframe as winequality_edited. 
+# - The store keeps the frame in memory for the next sections and writes a parquet checkpoint only when it changed.
 
 # In[ ]:
 
 
-wine_df.to_csv('winequality_edited.csv', index=False)
+store.put('winequality_edited', wine_df)
 
 
 # In[ ]:
 
 
-wine_df = pd.read_csv('winequality_edited.csv')
+wine_df = store.get('winequality_edited')
 wine_df.head(3)
 
 
@@ -330,8 +301,10 @@ wine_df['pH'].hist();
 # In[ ]:
 
 
-# Find the mean quality of each wine type (red and white) with groupby
-wine_df.groupby('color').mean().quality
+# Find the mean quality of each wine type (red and white) with groupby;
+# groups keeps the group codes of wine_df for all the comparisons below
+groups = GroupEngine(wine_df)
+groups.agg('color', 'quality', 'mean').quality
 
 
 # Q2: What level of acidity (pH value) receives the highest average rating?
@@ -348,15 +321,9 @@ wine_df.groupby('color').mean().quality
 # In[ ]:
 
 
-# View the min, 25%, 50%, 75%, max pH values with Pandas describe
-wine_df.describe().pH
-
-
-# In[ ]:
-
-
-# Bin edges that will be used to "cut" the data into groups
-bin_edges = [2.72, 3.11, 3.21, 3.32, 4.01] # Fill in this list with five values you just found
+# Bin edges that will be used to "cut" the data into groups: the min, 25%, 50%, 75%, max pH values
+bin_edges = quantile_edges(wine_df['pH'], [0, .25, .5, .75, 1])
+bin_edges
 
 
 # In[ ]:
@@ -369,8 +336,8 @@ bin_names = ['high', 'mod_high', 'medium', 'low'] # Name each acidity level cate
 # In[ ]:
 
 
-# Creates acidity_levels column
-wine_df['acidity_levels'] = pd.cut(wine_df['pH'], bin_edges, labels=bin_names)
+# Creates acidity_levels column, binned as pd.cut does (the lowest pH falls outside the bins)
+wine_df['acidity_levels'] = bin_values(wine_df['pH'], bin_edges, bin_names)
 
 # Checks for successful creation of this column
 wine_df.head()
@@ -382,26 +349,26 @@ wine_df.head()
 
 
 # Find the mean quality of each acidity level with groupby
-wine_df.groupby('acidity_levels').mean().quality
+groups.agg('acidity_levels', 'quality', 'mean').quality
 
 
 # In[ ]:
 
 
-wine_df.groupby(['quality','color'], as_index = False)['pH'].mean()
+groups.agg(['quality','color'], 'pH', 'mean').reset_index()
 
 
 # In[ ]:
 
 
-wine_df.groupby(['quality','color'], as_index = False)['fixed acidity', 'volatile acidity'].mean()
+groups.agg(['quality','color'], ['fixed acidity', 'volatile acidity'], 'mean').reset_index()
 
 
 # In[ ]:
 
 
 # Save changes for the next section
-wine_df.to_csv('winequality_edited.csv', index=False)
+store.put('winequality_edited', wine_df)
 
 
 # - Do wines with higher alcoholic content receive better ratings?
@@ -500,7 +467,7 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 get_ipython().run_line_magic('matplotlib', 'inline')
 colors = ['red', 'white']
-color_means = wine_df.groupby('color')['quality'].mean()
+color_means = groups.agg('color', 'quality', 'mean')['quality']
 color_means.plot(kind='bar', title='Average Wine Quality by Color', color=['red','white'], alpha=.7)
 plt.xlabel('Colors', fontsize=18)
 plt.ylabel('Quality', fontsize=18);
@@ -513,7 +480,7 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 get_ipython().run_line_magic('matplotlib', 'inline')
 
-counts = wine_df.groupby(['quality', 'color']).count()['pH']
+counts = groups.agg(['quality', 'color'], 'pH', 'count')['pH']
 counts.plot(kind='bar', title='Counts by Wine Color and Quality', color=colors, alpha=.7)
 plt.xlabel('Quality and Color' , fontsize=18)
 plt.ylabel('Count', fontsize=18);
@@ -548,7 +515,7 @@ plt.ylabel('Some Y Label');
 
 
 # Save changes for the next section
-wine_df.to_csv('winequality_edited.csv', index=False)
+store.put('winequality_edited', wine_df)
 
 
 # ### Plotting Wine Type and Quality with Matplotlib:
@@ -563,7 +530,7 @@ get_ipython().run_line_magic('matplotlib', 'inline')
 import seaborn as sns
 sns.set_style('darkgrid')
 
-wine_df = pd.read_csv('winequality_edited.csv')
+wine_df = store.get('winequality_edited')
 
 
 # ### Create arrays for red bar heights white bar heights:
@@ -575,8 +542,10 @@ wine_df = pd.read_csv('winequality_edited.csv')
 # In[ ]:
 
 
-# get counts for each rating and color
-color_counts = wine_df.groupby(['color', 'quality']).count()['pH']
+# get counts for each rating and color, and the total counts for each color, in one batch
+color_stats = group_aggregate(wine_df, {'color_counts': (['color', 'quality'], 'pH', 'count'),
+                                        'color_totals': ('color', 'pH', 'count')})
+color_counts = color_stats['color_counts']['pH']
 color_counts
 
 
@@ -584,7 +553,7 @@ color_counts
 
 
 # get total counts for each color
-color_totals = wine_df.groupby('color').count()['pH']
+color_totals = color_stats['color_totals']['pH']
 color_totals
 
 